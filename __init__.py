@@ -2,21 +2,13 @@ from __future__ import unicode_literals, division, absolute_import, print_functi
 
 __license__   = 'GPL v3'
 
-import time
 import re
-import json
-try:
-    from urllib import parse
-except ImportError:
-    import urllib
-try:
-    from queue import Empty, Queue
-except ImportError:
-    from Queue import Empty, Queue
-
-from calibre import as_unicode
+
 from calibre.ebooks.metadata.sources.base import Source
 
+# calibre imports this module in every process that might download metadata,
+# so everything else the plugin needs is imported on first use
+
 class WarGameVault(Source):
 
     name                    = 'WarGameVault'
@@ -34,13 +26,17 @@ class WarGameVault(Source):
 
     BASE_URL = 'https://www.wargamevault.com'
     BASE_API_URL = 'https://api.wargamevault.com/api/vBeta'
+    COVER_BASE_URL = 'https://d1vzi28wh99zvq.cloudfront.net/images/'
+
+    # Number of candidates taken from a title search
+    SEARCH_PAGE_SIZE = 6
 
     # This method is expected for a metadata source plugin
     def config_widget(self):
         '''
         Overriding the default configuration screen for our own custom configuration
         '''
-        from calibre_plugins.wargamevault.config import ConfigWidget
+        from calibre_plugins.wargamevault.config_widget import ConfigWidget
         return ConfigWidget(self)
 
     # This method is expected for a metadata source plugin
@@ -59,7 +55,8 @@ class WarGameVault(Source):
 
     # This method is expected for a metadata source plugin
     def id_from_url(self, url):
-        match = re.match(r'/products/(\d*)', url)
+        from calibre_plugins.wargamevault.product import PRODUCT_URL_PATTERN
+        match = PRODUCT_URL_PATTERN.match(url)
         if match:
             return (self.ID_NAME, match.groups(0)[0])
         return None
@@ -71,112 +68,545 @@ class WarGameVault(Source):
         if wargamevault_id is None:
             isbn = identifiers.get('isbn', None)
             if isbn is not None:
-                wargamevault_id = self.cached_isbn_to_identifier(isbn)
+                wargamevault_id = self.lookup_isbn(isbn)
         if wargamevault_id is not None:
             url = self.cached_identifier_to_cover_url(wargamevault_id)
+            if url is None:
+                url = self.get_stored_cover_url(wargamevault_id)
+
+        return url
+
+    # This method is custom to this plugin
+    def lookup_isbn(self, isbn):
+        '''
+        Find the WarGameVault id for an ISBN seen on a product in this or an
+        earlier session
+        '''
+        wargamevault_id = self.cached_isbn_to_identifier(isbn)
+        if wargamevault_id is None:
+            from calibre_plugins.wargamevault.cache import get_isbn_index
+            try:
+                isbn_index = get_isbn_index()
+                wargamevault_id = isbn_index.get(isbn) if isbn_index is not None else None
+            except:
+                return None
+            if wargamevault_id is not None:
+                self.cache_isbn_to_identifier(isbn, wargamevault_id)
+        return wargamevault_id
 
+    # This method is custom to this plugin
+    def get_stored_cover_url(self, wargamevault_id):
+        '''
+        Work out the cover URL from the product details in the on-disk cache,
+        so covers survive a restart without running identify again
+        '''
+        from calibre_plugins.wargamevault.cache import get_product_cache
+        from calibre_plugins.wargamevault.product import ProductRecord
+        try:
+            cache = get_product_cache()
+            raw = cache.get(wargamevault_id, allow_stale=True) if cache is not None else None
+            if not raw:
+                return None
+            image = ProductRecord.from_json(raw).image
+        except:
+            return None
+        if not image:
+            return None
+        url = self.COVER_BASE_URL + image
+        self.cache_identifier_to_cover_url(wargamevault_id, url)
+        from calibre_plugins.wargamevault.metrics import metrics
+        metrics.count('cover.stored_url')
         return url
 
     # This method is expected for a metadata source plugin
     def identify(self, log, result_queue, abort, title=None, authors=None,
             identifiers={}, timeout=30):
-        log.info('Started the identify method')
         '''
         Note this method will retry without identifiers automatically if no
         match is found with identifiers.
         '''
-        matches = []
+        import time
+        from calibre_plugins.wargamevault.config import (KEY_LOG_METRICS, KEY_METRICS_FILE,
+                get_options)
+        from calibre_plugins.wargamevault.metrics import metrics
+        # Taken once here and shared by every Worker for this book
+        options = get_options()
+        log_metrics, metrics_file = options.get(KEY_LOG_METRICS), options.get(KEY_METRICS_FILE)
+        # The metrics are process wide, so what this call did is the
+        # difference from a snapshot taken now
+        before = metrics.snapshot() if log_metrics or metrics_file else None
+        start = time.monotonic()
+        try:
+            return self.identify_with_options(log, result_queue, abort, title=title,
+                    authors=authors, identifiers=identifiers, timeout=timeout,
+                    options=options)
+        finally:
+            metrics.add_time('identify', time.monotonic() - start)
+            if before is not None:
+                run = metrics.since(before)
+                if log_metrics:
+                    log.info(metrics.summary(run))
+                if metrics_file:
+                    try:
+                        metrics.dump(metrics_file, {'identify': run, 'process': metrics.snapshot()})
+                    except:
+                        log.exception('Failed to write WarGameVault metrics to:', metrics_file)
+
+    # This method is custom to this plugin
+    def identify_with_options(self, log, result_queue, abort, title=None, authors=None,
+            identifiers={}, timeout=30, options=None):
+        log.info('Started the identify method')
         # Unlike the other metadata sources, if we have a WarGameVault id then we
         # do not need to fire a "search" at WarGameVault.com. Instead we will be
         # able to go straight to the URL for that book.
         wargamevault_id = identifiers.get(self.ID_NAME, None)
 
-        br = self.browser
+        from calibre_plugins.wargamevault.config import (KEY_SEARCH_PAGES,
+                KEY_STOP_ON_EXACT_MATCH, KEY_USE_LOCAL_INDEX)
+        from calibre_plugins.wargamevault.metrics import metrics
+        from calibre_plugins.wargamevault.network import Deadline
+        # Every request and Worker job made for this call stops once the
+        # user aborts or the timeout has passed
+        deadline = Deadline(timeout, abort)
+
+        isbn = identifiers.get('isbn', None)
+        if not wargamevault_id and isbn:
+            # An ISBN we have seen on a product before identifies it just as
+            # well as a WarGameVault id
+            wargamevault_id = self.lookup_isbn(isbn)
+            if wargamevault_id:
+                log.info('Found WarGameVault id %s for ISBN %s'%(wargamevault_id, isbn))
+                metrics.count('identify.isbn.hit')
+                identifiers = dict(identifiers)
+                identifiers[self.ID_NAME] = wargamevault_id
 
         if wargamevault_id:
             log.info('Found a WarGameVault id of %s'%wargamevault_id)
-            matches.append(self.get_book_dl_url(identifiers)[2])
-        else:
-            # Search WarGameVault using the title
-            title_tokens = list(self.get_title_tokens(title,
-                                strip_joiners=True, strip_subtitle=True))
-            title_text = ' '.join(title_tokens)
-            log.info('Constructed a title_text string of %s'%title_text)
-
-            query_params = parse.urlencode({'page':1,'pageSize':6,'groupId':1,'name':title_text,'order[matchWeight]':'desc',
-                                      'siteId':10,'contentRating[lte]':1,'status':1,'partial':'false'},quote_via=parse.quote)
-            #log.info('Constructed a urlencoded query_params string of %s'%query_params)
-            query_url = WarGameVault.BASE_API_URL + '/products?' + query_params
-
-            if query_params is None:
-                log.error('Insufficient metadata to construct query')
-                return
-            try:
-                log.info('Querying: %s'%query_url)
-                br.set_handle_redirect(True)
-                br.set_debug_redirects(True)
-                # Perform a product search on WarGameVault
-                response = br.open_novisit(query_url, timeout=timeout)
-                #log.info('Received search response of : %s'%response)
-            except Exception as e:
-                log.exception(e)
-                err = 'Failed to make identify query: %s'%(query_url)
-                log.exception(err)
-                return as_unicode(e)
-
-            # Get all the individual product URLs from the search response
-            try:
-                raw = response.read().strip()
-                if not raw:
-                    log.error('Failed to get raw result for query: %s'%(query_url))
-                    return
-                data = json.loads(raw)
-                for product in data['data']:
-                    product_url = WarGameVault.BASE_API_URL + '/products/' + str(product['attributes']['productId'])
-                    log.info('Identified product URL in search results: %s'%product_url)
-                    matches.append(product_url)
-            except:
-                msg = 'Failed to parse WarGameVault page for query: %s'%(query_url)
-                log.exception(msg)
-                return msg
-
-        if abort.is_set():
-            return
+            # A single known product needs neither a search nor a Worker job:
+            # parse it from the cache, or download it on this thread
+            from calibre_plugins.wargamevault.worker import Worker
+            w = Worker(self.get_book_dl_url(identifiers)[2], result_queue, None, log, 0, self,
+                    timeout=timeout, options=options, abort=deadline)
+            if not w.parse_cached():
+                w.browser = self.browser
+                try:
+                    w.get_details()
+                except:
+                    log.exception('get_details failed for url: %r'%w.url)
+            return None
 
-        log.info('Found %r matches in the query results'%(len(matches)))
-        #log.info('Matches: %r'%matches)
+        br = self.browser
+        local = []
+        if options.get(KEY_USE_LOCAL_INDEX):
+            local = self.search_local_index(log, title, authors, deadline)
+        # The index only holds products seen before, so WarGameVault is still
+        # searched unless the index already has the book itself
+        if local and any(exact for c, exact in self.rank_candidates(log, local, title,
+                authors, options, keep_best=False, log_scores=False)):
+            log.info('Found an exact match in the local catalog index, not searching WarGameVault')
+            metrics.count('identify.local_search.exact')
+            pages = iter([(1, local, None)])
+        else:
+            pages = self.search_remote(log, br, deadline, title, timeout,
+                    options.get(KEY_SEARCH_PAGES))
+            if local:
+                pages = self.merge_local(local, pages)
+        stop_on_exact = options.get(KEY_STOP_ON_EXACT_MATCH)
 
+        from concurrent.futures import FIRST_COMPLETED, wait
         from calibre_plugins.wargamevault.worker import Worker
-        workers = [Worker(url, result_queue, br, log, i, self) for i, url in
-                enumerate(matches)]
-
-        for w in workers:
-            w.start()
-            # Don't send all requests at the same time
-            time.sleep(0.1)
-
-        while not abort.is_set():
-            a_worker_is_alive = False
-            for w in workers:
-                w.join(0.2)
-                if abort.is_set():
+        from calibre_plugins.wargamevault.flight import ABORT_CHECK_INTERVAL
+        from calibre_plugins.wargamevault.pool import get_executor
+        executor = get_executor()
+        futures = {}
+        # Candidates held back while an exact match is downloading, and only
+        # queued once no exact match has panned out
+        held = []
+        relevance = 0
+        err = None
+        exact_found = False
+
+        def submit(w, exact):
+            futures[executor.submit(w.run)] = (w, exact)
+
+        def found_exact():
+            # Jobs for exact matches go first when the search stops at one, and
+            # the rest follow only if every one of them came up empty
+            if any(exact and f.done() and w.wargamevault_id
+                    for f, (w, exact) in futures.items()):
+                return True
+            if held and not any(exact and not f.done() for f, (w, exact) in futures.items()):
+                for w, exact in held:
+                    submit(w, exact)
+                del held[:]
+            return False
+
+        # Each page of results is ranked and its jobs queued as soon as it
+        # arrives, so the best matches are being downloaded while later pages
+        # are still being fetched
+        try:
+            for page, matches, page_err in pages:
+                if matches is None:
+                    if page == 1:
+                        err = page_err
+                    continue
+                if deadline.is_set():
                     break
-                if w.is_alive():
-                    a_worker_is_alive = True
-            if not a_worker_is_alive:
-                break
+
+                log.info('Found %r matches in page %d of the query results'%(len(matches), page))
+                #log.info('Matches: %r'%matches)
+                ranked = self.rank_candidates(log, matches, title, authors, options,
+                        keep_best=relevance == 0)
+                metrics.count('identify.candidates.skipped', len(matches) - len(ranked))
+
+                # Products we have already downloaded are parsed straight from
+                # the on-disk cache, only the remainder needs a Worker job
+                jobs = []
+                with metrics.timer('identify.cached'):
+                    for c, exact in ranked:
+                        w = Worker(c.url, result_queue, br, log, relevance, self, timeout=timeout,
+                                options=options, abort=deadline)
+                        relevance += 1
+                        if not w.parse_cached():
+                            jobs.append((w, exact))
+                        elif exact and stop_on_exact:
+                            log.info('Found an exact match in the cache')
+                            exact_found = True
+                            break
+                if exact_found:
+                    break
+                if stop_on_exact:
+                    for w, exact in jobs:
+                        if exact:
+                            submit(w, exact)
+                    for w, exact in jobs:
+                        if not exact:
+                            held.append((w, exact))
+                    if found_exact():
+                        # Leave the remaining pages unread
+                        exact_found = True
+                        break
+                else:
+                    for w, exact in jobs:
+                        submit(w, exact)
+        finally:
+            if hasattr(pages, 'close'):
+                pages.close()
+
+        if not futures and not held and relevance == 0 and err is not None:
+            return err
+
+        # Wake as soon as a job is done; the timeout only bounds how long it
+        # takes to notice an abort. Jobs still running when an exact match is
+        # found are waited for, so that nothing is queued after identify has
+        # returned.
+        skipped = False
+        with metrics.timer('identify.wait'):
+            while not deadline.is_set():
+                if stop_on_exact and not exact_found and found_exact():
+                    exact_found = True
+                if exact_found and not skipped:
+                    log.info('Found an exact match, skipping remaining candidates')
+                    metrics.count('identify.early_exit')
+                    skipped = True
+                    del held[:]
+                    for f in futures:
+                        f.cancel()
+                pending = [f for f in futures if not f.done()]
+                if not pending:
+                    break
+                wait(pending, timeout=ABORT_CHECK_INTERVAL, return_when=FIRST_COMPLETED)
+        if deadline.is_set():
+            # Jobs already running see the deadline and give up by themselves
+            for f in futures:
+                f.cancel()
 
         return None
 
+    # This method is custom to this plugin
+    def rank_candidates(self, log, candidates, title, authors, options, keep_best=True,
+            log_scores=True):
+        '''
+        Score search results against the requested title and authors using the
+        names and authors the search already returned, so that details are
+        only fetched for plausible matches. Returns (candidate, exact) pairs,
+        best first. If keep_best is True the best candidate is kept even when
+        all of them score poorly.
+        '''
+        from calibre_plugins.wargamevault.config import KEY_MIN_CANDIDATE_SCORE
+
+        def tokens(text):
+            return {t.lower() for t in self.get_title_tokens(text or '',
+                    strip_joiners=True, strip_subtitle=True)}
+
+        def words(text):
+            # Every word of the full name, subtitle and bracketed parts
+            # included, for deciding whether a match is exact
+            return re.findall(r'\w+', (text or '').lower(), re.UNICODE)
+
+        def author_tokens(names):
+            return {t.lower() for t in self.get_author_tokens(names or [],
+                    only_first_author=False)}
+
+        wanted_title, wanted_authors = tokens(title), author_tokens(authors)
+        wanted_words = words(title)
+        scored = []
+        for rank, c in enumerate(candidates):
+            if c.name is None:
+                # Nothing to judge it by, so leave it to the details
+                scored.append((0.5, rank, c, False))
+                continue
+            name = tokens(c.name)
+            common = len(wanted_title & name)
+            if not wanted_title or not name:
+                score = 0.0
+            else:
+                # Mostly how much of the wanted title is present, with a
+                # little weight on how little else the name contains
+                score = 0.7 * common / len(wanted_title) + 0.3 * common / len(name)
+            found_authors = author_tokens(c.authors)
+            author_match = not wanted_authors or not found_authors or \
+                    bool(wanted_authors & found_authors)
+            if not author_match:
+                score *= 0.5
+            exact = bool(wanted_words) and wanted_words == words(c.name) and author_match
+            scored.append((score, rank, c, exact))
+
+        scored.sort(key=lambda x: (-x[0], x[1]))
+        threshold = options.get(KEY_MIN_CANDIDATE_SCORE) / 100.0
+        ranked = [(c, exact) for score, rank, c, exact in scored if score >= threshold]
+        if keep_best and not ranked and scored and scored[0][0] > 0:
+            # Keep the best of a poor set rather than returning nothing
+            ranked = [(scored[0][2], scored[0][3])]
+        if log_scores:
+            for score, rank, c, exact in scored:
+                log.info('Candidate %s %r scored %.2f%s'%(c.url, c.name, score,
+                    ' (exact match)' if exact else ''))
+        return ranked
+
+    # This method is custom to this plugin
+    def merge_local(self, local, pages):
+        '''
+        Add the candidates from the local catalog index to the first page of
+        search results, so that they are ranked together, and drop them from
+        later pages
+        '''
+        seen = {c.url for c in local}
+        first = True
+        try:
+            for page, matches, err in pages:
+                if matches is not None:
+                    matches = [c for c in matches if c.url not in seen]
+                if first:
+                    first = False
+                    # A failed search still leaves the local candidates
+                    yield page, local + (matches or []), None
+                else:
+                    yield page, matches, err
+            if first:
+                # WarGameVault found nothing, or was not asked again
+                yield 1, local, None
+        finally:
+            pages.close()
+
+    # This method is custom to this plugin
+    def search_local_index(self, log, title, authors, abort=None):
+        '''
+        Look the title up in the local catalog index, returning Candidates for
+        the best matches
+        '''
+        from calibre_plugins.wargamevault.catalog import get_catalog_index
+        from calibre_plugins.wargamevault.metrics import metrics
+        from calibre_plugins.wargamevault.product import Candidate
+        title_tokens = list(self.get_title_tokens(title,
+                            strip_joiners=True, strip_subtitle=True))
+        author_tokens = list(self.get_author_tokens(authors or [], only_first_author=False))
+        try:
+            index = get_catalog_index()
+            with metrics.timer('identify.local_search'):
+                rows = index.search(title_tokens, author_tokens,
+                        limit=self.SEARCH_PAGE_SIZE, abort=abort) if index is not None else []
+        except:
+            log.exception('Failed to search the local WarGameVault catalog index')
+            return []
+        metrics.count('identify.local_search.hit' if rows else 'identify.local_search.miss')
+        matches = [Candidate('%s/products/%s'%(self.BASE_API_URL, i), name, product_authors)
+                for i, name, product_authors in rows]
+        for c in matches:
+            log.info('Identified product URL in local catalog index: %s'%c.url)
+        return matches
+
+    # This method is custom to this plugin
+    def search_remote(self, log, br, abort, title, timeout, pages=1):
+        '''
+        Search WarGameVault using the title, fetching the first pages pages of
+        results at the same time. Yields (page, candidates, error) for each
+        page as it arrives, page 1 first. candidates only holds products not
+        seen on an earlier page, or is None when the page could not be read,
+        with error the value identify should return.
+        '''
+        from concurrent.futures import FIRST_COMPLETED, wait
+        from calibre_plugins.wargamevault.flight import ABORT_CHECK_INTERVAL
+        from calibre_plugins.wargamevault.metrics import metrics
+        title_tokens = list(self.get_title_tokens(title,
+                            strip_joiners=True, strip_subtitle=True))
+        title_text = ' '.join(title_tokens)
+        log.info('Constructed a title_text string of %s'%title_text)
+
+        from calibre_plugins.wargamevault.cache import get_negative_cache
+        try:
+            negative_cache = get_negative_cache()
+            miss_key = negative_cache.search_key(title_tokens) if negative_cache is not None else None
+            if miss_key is not None and negative_cache.get(miss_key):
+                log.info('WarGameVault found nothing for this title recently, not searching again')
+                metrics.count('identify.search.known_miss')
+                return
+        except:
+            log.exception('Failed to read the WarGameVault negative cache')
+            negative_cache = None
+
+        # Every page, the first included, is fetched on the worker pool with a
+        # browser of its own, so that waiting for one can stop on an abort
+        from calibre_plugins.wargamevault.network import Deadline
+        from calibre_plugins.wargamevault.pool import get_browser_pool, get_executor
+
+        def search_pooled_page(page):
+            with get_browser_pool().browser(br) as page_br:
+                return page, self.search_page(log, page_br, abort, title_text, page, timeout)
+
+        executor = get_executor()
+        futures = [executor.submit(search_pooled_page, page) for page in range(1, pages + 1)]
+        # Running out of time is reported by the search itself, which has
+        # its request timeout cut to the deadline
+        aborted = abort.aborted if isinstance(abort, Deadline) else abort.is_set
+
+        seen = set()
+
+        def unseen(matches):
+            if matches is None:
+                return None
+            fresh = [c for c in matches if c.url not in seen]
+            seen.update(c.url for c in fresh)
+            metrics.count('identify.search.duplicates', len(matches) - len(fresh))
+            return fresh
+
+        try:
+            while not futures[0].done():
+                if aborted():
+                    log.info('Stopped waiting for search results')
+                    return
+                wait(futures[:1], timeout=ABORT_CHECK_INTERVAL)
+            page, (matches, err) = futures[0].result()
+            if matches is not None and not matches:
+                if negative_cache is not None:
+                    try:
+                        negative_cache.put(miss_key)
+                    except:
+                        log.exception('Failed to remember empty search for: %s'%title_text)
+                # Later pages of an empty search are empty too
+                return
+            if matches is None and err is None:
+                return
+            yield 1, unseen(matches), err
+            pending = set(futures[1:])
+            if matches is not None and len(matches) < self.SEARCH_PAGE_SIZE:
+                # A short first page is the last one, so later pages are
+                # dropped unless they are already being searched
+                skipped = {f for f in pending if f.cancel()}
+                metrics.count('identify.search.pages_skipped', len(skipped))
+                pending -= skipped
+            while pending:
+                if abort is not None and abort.is_set():
+                    # The deadline is shared with the page searches, so any
+                    # still running are about to give up anyway
+                    log.info('Stopped waiting for later pages of search results')
+                    return
+                done, pending = wait(pending, timeout=ABORT_CHECK_INTERVAL,
+                        return_when=FIRST_COMPLETED)
+                for f in done:
+                    page, (matches, err) = f.result()
+                    if matches is not None or err is not None:
+                        yield page, unseen(matches), err
+        finally:
+            for f in futures:
+                f.cancel()
+
+    # This method is custom to this plugin
+    def search_page(self, log, br, abort, title_text, page, timeout):
+        '''
+        Fetch one page of search results. Returns a list of Candidates and
+        None, or None and the value identify should return.
+        '''
+        import json
+        from urllib import parse
+        from calibre import as_unicode
+        from calibre_plugins.wargamevault.metrics import metrics
+        from calibre_plugins.wargamevault.network import Aborted, Deadline, open_url, redirect_log
+        from calibre_plugins.wargamevault.product import Candidate
+        matches = []
+        query_params = parse.urlencode({'page':page,'pageSize':self.SEARCH_PAGE_SIZE,'groupId':1,'name':title_text,'order[matchWeight]':'desc',
+                                  'siteId':10,'contentRating[lte]':1,'status':1,'partial':'false'},quote_via=parse.quote)
+        #log.info('Constructed a urlencoded query_params string of %s'%query_params)
+        query_url = self.BASE_API_URL + '/products?' + query_params
+
+        if query_params is None:
+            log.error('Insufficient metadata to construct query')
+            return None, None
+        try:
+            log.info('Querying: %s'%query_url)
+            br.set_handle_redirect(True)
+            br.set_debug_redirects(True)
+            # Perform a product search on WarGameVault
+            with metrics.timer('identify.search'), redirect_log.routing_to(log):
+                response = open_url(br, query_url, timeout, abort=abort, log=log)
+                raw = response.read().strip()
+            #log.info('Received search response of : %s'%response)
+        except Aborted:
+            if isinstance(abort, Deadline) and not abort.aborted():
+                msg = 'WarGameVault timed out. Try again later.'
+                log.error(msg)
+                return None, msg
+            return None, None
+        except Exception as e:
+            log.exception(e)
+            err = 'Failed to make identify query: %s'%(query_url)
+            log.exception(err)
+            return None, as_unicode(e)
+
+        # Get all the individual product URLs from the search response
+        try:
+            if not raw:
+                log.error('Failed to get raw result for query: %s'%(query_url))
+                metrics.count('identify.search.empty')
+                return None, None
+            data = json.loads(raw)
+            for product in data['data']:
+                attributes = product['attributes']
+                product_url = self.BASE_API_URL + '/products/' + str(attributes['productId'])
+                log.info('Identified product URL in search results: %s'%product_url)
+                name = (attributes.get('description') or {}).get('name') or attributes.get('name')
+                matches.append(Candidate(product_url, name, attributes.get('authors') or []))
+        except:
+            msg = 'Failed to parse WarGameVault page for query: %s'%(query_url)
+            log.exception(msg)
+            return None, msg
+        return matches, None
+
     # This method is expected for a metadata source plugin
     def download_cover(self, log, result_queue, abort,
             title=None, authors=None, identifiers={}, timeout=30):
-        cached_url = self.get_cached_cover_url(identifiers)
+        from queue import Empty, Queue
+        from calibre_plugins.wargamevault.metrics import metrics
+        from calibre_plugins.wargamevault.network import Deadline
+        deadline = Deadline(timeout, abort)
+        with metrics.timer('cover.resolve'):
+            cached_url = self.get_cached_cover_url(identifiers)
         if cached_url is None:
             log.info('No cached cover found, running identify')
+            metrics.count('cover.identify')
             rq = Queue()
             self.identify(log, rq, abort, title=title, authors=authors,
-                    identifiers=identifiers)
+                    identifiers=identifiers, timeout=timeout)
             if abort.is_set():
                 return
             results = []
@@ -197,13 +627,50 @@ class WarGameVault(Source):
 
         if abort.is_set():
             return
+        from calibre_plugins.wargamevault.cache import get_cover_cache
+        from calibre_plugins.wargamevault.network import error_code, open_url
+        try:
+            cover_cache = get_cover_cache()
+            cached = cover_cache.get(cached_url) if cover_cache is not None else None
+        except:
+            log.exception('Failed to read cached cover for:', cached_url)
+            cover_cache = cached = None
+
+        # Revalidate a cached cover rather than downloading it again
+        headers = {}
+        if cached is not None:
+            if cached[1]:
+                headers['If-None-Match'] = cached[1]
+            if cached[2]:
+                headers['If-Modified-Since'] = cached[2]
+
         br = self.browser
         log('Downloading cover from:', cached_url)
+        metrics.count('cache.cover.hit' if cached is not None else 'cache.cover.miss')
         try:
-            cdata = br.open_novisit(cached_url, timeout=timeout).read()
-            result_queue.put((self, cdata))
-        except:
-            log.exception('Failed to download cover from:', cached_url)
+            with metrics.timer('cover.download'):
+                response = open_url(br, cached_url, timeout, abort=deadline, log=log,
+                        headers=headers)
+                cdata = response.read()
+        except Exception as e:
+            if cached is None or abort.is_set():
+                log.exception('Failed to download cover from:', cached_url)
+                return
+            if error_code(e) == 304:
+                log('Cached cover is unchanged:', cached_url)
+                metrics.count('cover.not_modified')
+            else:
+                log.exception('Failed to revalidate cover, using cached copy of:', cached_url)
+            result_queue.put((self, cached[0]))
+            return
+
+        result_queue.put((self, cdata))
+        if cover_cache is not None:
+            try:
+                info = response.info()
+                cover_cache.put(cached_url, cdata, info.get('ETag'), info.get('Last-Modified'))
+            except:
+                log.exception('Failed to cache cover from:', cached_url)
 
 if __name__ == '__main__': # tests
     # To run these test use:
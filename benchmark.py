@@ -0,0 +1,469 @@
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+__license__   = 'GPL v3'
+
+'''
+Offline benchmarks for the WarGameVault metadata source.
+
+A local mock of the WarGameVault API is started and the plugin is pointed at
+it, then batches of books are identified (and optionally have their covers
+downloaded) while throughput, latency and thread count are measured. Memory
+is traced in a second pass over the same books, so that tracing does not slow
+down the timed one. With the plugin installed, run:
+
+    calibre-debug -e benchmark.py -- --sizes 1,100,10000
+
+Use --fixtures to serve recorded product responses (a directory of
+<product id>.json files saved from /products/<id>) instead of the generated
+catalog, and --latency, --jitter, --throttle-rate and --timeout-rate to make
+the mock API misbehave. The run fails with an AssertionError if a batch leaves
+more than one handler on mechanize's redirect logger or keeps growing in
+memory when its books are identified again. --import-time instead measures
+how long importing the plugin takes. --help lists every option.
+'''
+
+import gc
+import os
+import re
+import sys
+import json
+import time
+import logging
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+import zlib
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+API_PATH = '/api/vBeta'
+
+# Batches smaller than this are too small to tell a leak from warming up
+MIN_BOOKS_FOR_MEMORY_CHECK = 100
+# Memory identifying the second half of a batch again may keep on top of what
+# identifying the first half again kept
+MAX_MEMORY_GROWTH_KB = 1024
+IMAGES_PATH = '/images/'
+
+WORDS = ('ancient', 'azure', 'bastion', 'crimson', 'dragon', 'ember', 'frontier',
+        'gloom', 'harbor', 'iron', 'jade', 'keep', 'lantern', 'marsh', 'night',
+        'oath', 'pale', 'quarry', 'raven', 'salt', 'thorn', 'umbral', 'vale',
+        'warden', 'yonder', 'zenith')
+
+def generate_product(product_id):
+    rnd = random.Random(product_id)
+    words = [rnd.choice(WORDS) for i in range(3)]
+    name = 'The %s %s of %s %d'%(words[0].title(), words[1].title(),
+            words[2].title(), product_id)
+    included = [{'type': 'Publisher', 'attributes': {'name': 'Mock Games %d'%(product_id % 50)}}]
+    for kind in ('Category', 'Filter'):
+        for i in range(rnd.randint(2, 12)):
+            included.append({'type': kind, 'attributes': {
+                'descriptions': [{'name': '%s %s'%(kind, rnd.choice(WORDS).title())}]}})
+    return {
+        'data': {
+            'id': str(product_id),
+            'attributes': {
+                'productId': product_id,
+                'description': {'name': name,
+                    'description': '<p>%s</p>'%' '.join(rnd.choice(WORDS) for i in range(400))},
+                'authors': ['Author %d'%(product_id % 200)],
+                'artists': ['Artist %d'%(product_id % 30)],
+                'editors': [],
+                'contributors': [],
+                'isbn': '978%010d'%product_id if product_id % 3 == 0 else None,
+                'image': '%d/cover.jpg'%product_id,
+                'dateCreated': '2020-01-%02dT00:00:00'%(product_id % 28 + 1),
+            },
+        },
+        'included': included,
+    }
+
+def load_fixtures(path):
+    products = {}
+    for name in os.listdir(path):
+        if name.endswith('.json'):
+            with open(os.path.join(path, name), 'rb') as f:
+                data = json.loads(f.read())
+            products[int(data['data']['attributes']['productId'])] = data
+    return products
+
+def tokens(text):
+    return set(re.findall(r'\w+', text.lower()))
+
+class MockCatalog(object):
+
+    def __init__(self, products):
+        self.products = products
+        self.bodies = {pid: json.dumps(p).encode('utf-8') for pid, p in products.items()}
+        self.index = {}
+        for pid, p in products.items():
+            for token in tokens(self.name(pid)):
+                self.index.setdefault(token, set()).add(pid)
+
+    def name(self, product_id):
+        return self.products[product_id]['data']['attributes']['description']['name']
+
+    def search(self, text, page, page_size):
+        found = None
+        for token in tokens(text):
+            ids = self.index.get(token, set())
+            found = ids if found is None else found & ids
+        found = sorted(found or ())
+        hits = found[(page - 1) * page_size:page * page_size]
+        return json.dumps({'data': [{'attributes': {'productId': pid,
+            'description': {'name': self.name(pid)}}} for pid in hits]}).encode('utf-8')
+
+class MockAPIHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def send_body(self, code, body, headers=()):
+        self.send_response(code)
+        for k, v in headers:
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        server.count('requests')
+        delay = max(0.0, random.gauss(server.latency, server.jitter))
+        roll = random.random()
+        if roll < server.timeout_rate:
+            server.count('timeouts')
+            time.sleep(server.timeout_delay)
+            self.close_connection = True
+            return
+        time.sleep(delay)
+        if roll < server.timeout_rate + server.throttle_rate:
+            server.count('throttled')
+            return self.send_body(429, b'', [('Retry-After', '1')])
+
+        url = urlparse(self.path)
+        if url.path == API_PATH + '/products':
+            q = parse_qs(url.query)
+            server.count('searches')
+            body = server.catalog.search(q.get('name', [''])[0],
+                    int(q.get('page', ['1'])[0]), int(q.get('pageSize', ['6'])[0]))
+            return self.send_body(200, body, [('Content-Type', 'application/json')])
+        match = re.match(re.escape(API_PATH) + r'/products/(\d+)$', url.path)
+        if match:
+            server.count('products')
+            body = server.catalog.bodies.get(int(match.group(1)))
+            if body is None:
+                return self.send_body(404, b'{}')
+            etag = '"%08x"'%zlib.crc32(body)
+            if self.headers.get('If-None-Match') == etag:
+                server.count('not_modified')
+                return self.send_body(304, b'', [('ETag', etag)])
+            return self.send_body(200, body, [('Content-Type', 'application/json'), ('ETag', etag)])
+        if url.path.startswith(IMAGES_PATH):
+            server.count('covers')
+            etag = '"%s"'%url.path.split('/')[2]
+            if self.headers.get('If-None-Match') == etag:
+                return self.send_body(304, b'', [('ETag', etag)])
+            return self.send_body(200, b'\xff\xd8' + b'\0' * 30000,
+                    [('Content-Type', 'image/jpeg'), ('ETag', etag)])
+        self.send_body(404, b'')
+
+class MockAPIServer(ThreadingHTTPServer):
+
+    daemon_threads = True
+    # Clients hang up on requests they stop waiting for, after an abort,
+    # a timeout or a retry on another connection
+    dropped_errors = (BrokenPipeError, ConnectionResetError, ConnectionAbortedError)
+
+    def __init__(self, catalog, latency=0.05, jitter=0.01, throttle_rate=0.0,
+            timeout_rate=0.0, timeout_delay=2.0):
+        ThreadingHTTPServer.__init__(self, ('127.0.0.1', 0), MockAPIHandler)
+        self.catalog = catalog
+        self.latency, self.jitter = latency, jitter
+        self.throttle_rate, self.timeout_rate = throttle_rate, timeout_rate
+        self.timeout_delay = timeout_delay
+        self.counters = {}
+        self.counters_lock = threading.Lock()
+
+    def count(self, name):
+        with self.counters_lock:
+            self.counters[name] = self.counters.get(name, 0) + 1
+
+    def reset_counters(self):
+        with self.counters_lock:
+            counters, self.counters = self.counters, {}
+        return counters
+
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], self.dropped_errors):
+            ThreadingHTTPServer.handle_error(self, request, client_address)
+
+    @property
+    def base_url(self):
+        return 'http://127.0.0.1:%d'%self.server_address[1]
+
+class ThreadSampler(threading.Thread):
+
+    def __init__(self, interval=0.01):
+        threading.Thread.__init__(self, daemon=True)
+        self.interval, self.peak = interval, threading.active_count()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.peak = max(self.peak, threading.active_count())
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))]
+
+def make_books(catalog, size, mode):
+    ids = sorted(catalog.products)
+    books = []
+    for i in range(size):
+        pid = ids[i % len(ids)]
+        if mode == 'id' or (mode == 'mixed' and i % 10):
+            books.append({'identifiers': {'wargamevault': str(pid)}})
+        else:
+            attrs = catalog.products[pid]['data']['attributes']
+            books.append({'title': attrs['description']['name'],
+                'authors': attrs['authors'], 'identifiers': {}})
+    return books
+
+def identify_books(plugin, log, books, parallel, covers):
+    '''
+    Identify books, parallel at a time, returning how long each took and how
+    many results were found
+    '''
+    abort = threading.Event()
+    latencies, results = [], [0]
+    lock = threading.Lock()
+
+    def one(book):
+        start = time.monotonic()
+        rq = Queue()
+        plugin.identify(log, rq, abort, title=book.get('title'),
+                authors=book.get('authors'), identifiers=book['identifiers'])
+        found = rq.qsize()
+        if covers and found:
+            cq = Queue()
+            plugin.download_cover(log, cq, abort, title=book.get('title'),
+                    authors=book.get('authors'), identifiers=rq.get().identifiers)
+        elapsed = time.monotonic() - start
+        with lock:
+            latencies.append(elapsed)
+            results[0] += found
+
+    with ThreadPoolExecutor(max_workers=parallel) as pool:
+        list(pool.map(one, books))
+    return latencies, results[0]
+
+def run_batch(plugin, log, books, parallel, covers):
+    sampler = ThreadSampler()
+    sampler.start()
+    start = time.monotonic()
+    latencies, results = identify_books(plugin, log, books, parallel, covers)
+    wall = time.monotonic() - start
+    sampler.stopped.set()
+    sampler.join()
+    return {
+        'books': len(books),
+        'results': results,
+        'wall_seconds': round(wall, 3),
+        'books_per_second': round(len(books) / wall, 2) if wall else None,
+        'p50_seconds': round(percentile(latencies, 50), 4),
+        'p99_seconds': round(percentile(latencies, 99), 4),
+        'peak_threads': sampler.peak,
+    }
+
+def measure_memory(plugin, log, books, parallel, covers):
+    '''
+    Identify books that have all been identified before again, one half after
+    the other, with memory traced. Returns the peak memory in KB and the
+    memory in KB the second half kept on top of what the first half kept.
+
+    calibre keeps an entry for every new product identified, so only books it
+    has already seen are expected to leave the same memory behind each time,
+    and anything the second half then adds is a leak.
+    '''
+    def retained_memory():
+        gc.collect()
+        return tracemalloc.get_traced_memory()[0]
+
+    half = len(books) // 2
+    tracemalloc.start()
+    try:
+        identify_books(plugin, log, books[:half], parallel, covers)
+        half_retained = retained_memory()
+        identify_books(plugin, log, books[half:], parallel, covers)
+        retained = retained_memory()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return peak // 1024, (retained - half_retained) // 1024
+
+def check_batch(result):
+    '''
+    Return the problems a batch shows with the plugin, if any
+    '''
+    problems = []
+    if result['redirect_log_handlers'] > 1:
+        problems.append('%d books: %d handlers on the redirect logger, expected at most 1'%(
+            result['books'], result['redirect_log_handlers']))
+    if result['books'] >= MIN_BOOKS_FOR_MEMORY_CHECK and \
+            result['memory_growth_kb'] > MAX_MEMORY_GROWTH_KB:
+        problems.append('%d books: memory grew by %dKB identifying the second half of the batch again'%(
+            result['books'], result['memory_growth_kb']))
+    return problems
+
+PLUGIN_PACKAGE = 'calibre_plugins.wargamevault'
+
+def measure_imports():
+    '''
+    Import the plugin afresh, timing loading just the plugin class (what
+    calibre does in every process that can download metadata) separately from
+    loading what the first identify call needs
+    '''
+    import importlib
+    for name in [m for m in sys.modules if m == PLUGIN_PACKAGE or m.startswith(PLUGIN_PACKAGE + '.')]:
+        del sys.modules[name]
+    before = set(sys.modules)
+    start = time.perf_counter()
+    importlib.import_module(PLUGIN_PACKAGE)
+    class_seconds = time.perf_counter() - start
+    after_class = set(sys.modules)
+    config = sys.modules.get(PLUGIN_PACKAGE + '.config')
+    prefs_read = config is not None and config._plugin_prefs is not None
+    start = time.perf_counter()
+    importlib.import_module(PLUGIN_PACKAGE + '.worker')
+    identify_seconds = time.perf_counter() - start
+    after_identify = set(sys.modules)
+    return {
+        'class_import_seconds': round(class_seconds, 4),
+        'class_import_modules': sorted(after_class - before),
+        'class_import_read_prefs': prefs_read,
+        'identify_import_seconds': round(identify_seconds, 4),
+        'identify_import_modules': len(after_identify - after_class),
+        'identify_import_loaded_qt': any(m.split('.')[0] in ('qt', 'PyQt5', 'PyQt6')
+            for m in after_identify - before),
+    }
+
+def option_parser():
+    parser = argparse.ArgumentParser(description='Benchmark the WarGameVault source against a local mock API')
+    parser.add_argument('--sizes', default='1,100,10000',
+            help='Comma separated batch sizes to run (default: %(default)s)')
+    parser.add_argument('--mode', choices=('id', 'title', 'mixed'), default='mixed',
+            help='Identify books by WarGameVault id, by title, or 90%% by id (default: %(default)s)')
+    parser.add_argument('--parallel', type=int, default=4,
+            help='Books identified at the same time (default: %(default)s)')
+    parser.add_argument('--covers', action='store_true', help='Also download a cover for every book')
+    parser.add_argument('--warm', action='store_true',
+            help='Keep the on-disk caches between batches instead of starting each one cold')
+    parser.add_argument('--fixtures', help='Directory of recorded /products/<id> JSON responses to serve')
+    parser.add_argument('--latency', type=float, default=0.05, help='Mean response latency in seconds')
+    parser.add_argument('--jitter', type=float, default=0.01, help='Standard deviation of the latency')
+    parser.add_argument('--throttle-rate', type=float, default=0.0,
+            help='Fraction of requests answered with 429 and Retry-After: 1')
+    parser.add_argument('--timeout-rate', type=float, default=0.0,
+            help='Fraction of requests that hang and are then dropped')
+    parser.add_argument('--timeout-delay', type=float, default=2.0,
+            help='How long a hanging request hangs for, in seconds')
+    parser.add_argument('--import-time', action='store_true',
+            help='Only measure how long the plugin takes to import')
+    parser.add_argument('--output', help='Also write the results as JSON to this file')
+    parser.add_argument('--verbose', action='store_true', help='Show the plugin log')
+    return parser
+
+def main(args=sys.argv[1:]):
+    opts = option_parser().parse_args(args)
+    sizes = [int(x) for x in opts.sizes.split(',') if x.strip()]
+
+    from calibre.customize.ui import metadata_sources
+    from calibre.utils.logging import ThreadSafeLog
+    plugin = [p for p in metadata_sources() if p.name == 'WarGameVault'][0]
+    if opts.import_time:
+        result = measure_imports()
+        print(('plugin class %(class_import_seconds).4fs  first identify %(identify_import_seconds).4fs '
+            '(%(identify_import_modules)d modules, Qt loaded: %(identify_import_loaded_qt)s)')%result)
+        print('Loaded with the plugin class:', ', '.join(result['class_import_modules']))
+        if opts.output:
+            with open(opts.output, 'w') as f:
+                json.dump(result, f, indent=2)
+        return result
+    from calibre_plugins.wargamevault import cache
+    from calibre_plugins.wargamevault.metrics import metrics
+
+    if opts.fixtures:
+        products = load_fixtures(opts.fixtures)
+    else:
+        products = {pid: generate_product(pid) for pid in range(100000, 100000 + max(sizes))}
+    catalog = MockCatalog(products)
+    server = MockAPIServer(catalog, latency=opts.latency, jitter=opts.jitter,
+            throttle_rate=opts.throttle_rate, timeout_rate=opts.timeout_rate,
+            timeout_delay=opts.timeout_delay)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    cls = plugin.__class__
+    original_urls = cls.BASE_API_URL, cls.COVER_BASE_URL
+    cls.BASE_API_URL = server.base_url + API_PATH
+    cls.COVER_BASE_URL = server.base_url + IMAGES_PATH
+    log = ThreadSafeLog(level=ThreadSafeLog.DEBUG if opts.verbose else ThreadSafeLog.ERROR)
+    tdir = tempfile.mkdtemp(prefix='wargamevault-bench-')
+
+    report = {'options': vars(opts), 'batches': []}
+    try:
+        for i, size in enumerate(sizes):
+            if not opts.warm:
+                cache_dir = os.path.join(tdir, str(i))
+                os.makedirs(cache_dir)
+                cache.use_cache_dir(cache_dir)
+            elif i == 0:
+                cache.use_cache_dir(tdir)
+            server.reset_counters()
+            metrics.reset()
+            books = make_books(catalog, size, opts.mode)
+            result = run_batch(plugin, log, books, opts.parallel, opts.covers)
+            result['server'] = server.reset_counters()
+            result['plugin'] = metrics.snapshot()
+            result['peak_traced_memory_kb'], result['memory_growth_kb'] = measure_memory(
+                    plugin, log, books, opts.parallel, opts.covers)
+            # Must stay at one (none if nothing was downloaded) however many
+            # books have been identified
+            result['redirect_log_handlers'] = len(
+                    logging.getLogger('mechanize.http_redirects').handlers)
+            result['problems'] = check_batch(result)
+            report['batches'].append(result)
+            print(('%(books)6d books  %(wall_seconds)8.2fs  %(books_per_second)8.2f books/s  '
+                'p50 %(p50_seconds).3fs  p99 %(p99_seconds).3fs  threads %(peak_threads)d  '
+                'memory %(peak_traced_memory_kb)dKB (+%(memory_growth_kb)dKB)  '
+                'log handlers %(redirect_log_handlers)d')%result,
+                result['server'])
+    finally:
+        cls.BASE_API_URL, cls.COVER_BASE_URL = original_urls
+        cache.use_cache_dir(None)
+        server.shutdown()
+        shutil.rmtree(tdir, ignore_errors=True)
+
+    if opts.output:
+        with open(opts.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    problems = [p for result in report['batches'] for p in result['problems']]
+    if problems:
+        raise AssertionError('Benchmark found problems:\n' + '\n'.join(problems))
+    return report
+
+if __name__ == '__main__':
+    main()
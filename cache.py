@@ -0,0 +1,411 @@
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+__license__   = 'GPL v3'
+
+import os
+import time
+import sqlite3
+import hashlib
+from threading import RLock
+
+import calibre_plugins.wargamevault.config as cfg
+
+CACHE_DIR_NAME = 'wargamevault'
+CACHE_FILE_NAME = 'cache.sqlite'
+COVERS_DIR_NAME = 'covers'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS products (
+    id TEXT PRIMARY KEY,
+    raw TEXT NOT NULL,
+    fetched REAL NOT NULL,
+    accessed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS products_accessed ON products (accessed);
+CREATE TABLE IF NOT EXISTS product_states (
+    id TEXT PRIMARY KEY,
+    etag TEXT,
+    last_modified TEXT,
+    fingerprint TEXT,
+    metadata TEXT
+);
+CREATE TABLE IF NOT EXISTS covers (
+    url TEXT PRIMARY KEY,
+    etag TEXT,
+    last_modified TEXT,
+    size INTEGER NOT NULL,
+    accessed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS covers_accessed ON covers (accessed);
+CREATE TABLE IF NOT EXISTS isbns (
+    isbn TEXT PRIMARY KEY,
+    id TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS misses (
+    key TEXT PRIMARY KEY,
+    created REAL NOT NULL
+);
+'''
+
+# Set by use_cache_dir to keep the caches somewhere other than calibre's
+# cache directory
+_cache_dir_override = None
+
+def default_cache_dir():
+    if _cache_dir_override is not None:
+        base = _cache_dir_override
+    else:
+        from calibre.constants import cache_dir
+        base = os.path.join(cache_dir(), CACHE_DIR_NAME)
+    if not os.path.exists(base):
+        os.makedirs(base)
+    return base
+
+def default_cache_path():
+    return os.path.join(default_cache_dir(), CACHE_FILE_NAME)
+
+def open_db(path):
+    conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.executescript(SCHEMA)
+    return conn
+
+class ProductCache(object):
+
+    '''
+    Persistent cache of WarGameVault product JSON keyed by WarGameVault id.
+    Entries older than ttl seconds are treated as missing, and once more than
+    max_entries are stored the least recently used ones are evicted.
+    '''
+
+    def __init__(self, path, ttl=30*86400, max_entries=20000):
+        self.path = path
+        self.ttl, self.max_entries = ttl, max_entries
+        self.lock = RLock()
+        self.conn = open_db(path)
+
+    def configure(self, ttl, max_entries):
+        with self.lock:
+            self.ttl, self.max_entries = ttl, max_entries
+
+    def is_fresh(self, fetched, now=None):
+        if now is None:
+            now = time.time()
+        return self.ttl <= 0 or now - fetched <= self.ttl
+
+    def get(self, wargamevault_id, allow_stale=False):
+        if not wargamevault_id:
+            return None
+        key = str(wargamevault_id)
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute('SELECT raw, fetched FROM products WHERE id=?',
+                    (key,)).fetchone()
+            if row is None:
+                return None
+            raw, fetched = row
+            if not allow_stale and not self.is_fresh(fetched, now):
+                return None
+            self.conn.execute('UPDATE products SET accessed=? WHERE id=?', (now, key))
+        return raw
+
+    def put(self, wargamevault_id, raw):
+        if not wargamevault_id or not raw:
+            return
+        if isinstance(raw, bytes):
+            raw = raw.decode('utf-8', errors='replace')
+        now = time.time()
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO products (id, raw, fetched, accessed) '
+                    'VALUES (?, ?, ?, ?)', (str(wargamevault_id), raw, now, now))
+            self.evict()
+
+    def touch(self, wargamevault_id):
+        '''
+        Mark a cached product as just downloaded, after the server confirmed
+        it is unchanged
+        '''
+        now = time.time()
+        with self.lock:
+            self.conn.execute('UPDATE products SET fetched=?, accessed=? WHERE id=?',
+                    (now, now, str(wargamevault_id)))
+
+    def get_state(self, wargamevault_id):
+        '''
+        Return (etag, last_modified, fingerprint, metadata) kept for a product
+        by the incremental refresh, or None
+        '''
+        with self.lock:
+            return self.conn.execute('SELECT etag, last_modified, fingerprint, metadata '
+                    'FROM product_states WHERE id=?', (str(wargamevault_id),)).fetchone()
+
+    def put_validators(self, wargamevault_id, etag, last_modified):
+        with self.lock:
+            self.conn.execute('INSERT INTO product_states (id, etag, last_modified) VALUES (?, ?, ?) '
+                    'ON CONFLICT(id) DO UPDATE SET etag=excluded.etag, '
+                    'last_modified=excluded.last_modified',
+                    (str(wargamevault_id), etag, last_modified))
+
+    def put_metadata(self, wargamevault_id, fingerprint, metadata):
+        with self.lock:
+            self.conn.execute('INSERT INTO product_states (id, fingerprint, metadata) VALUES (?, ?, ?) '
+                    'ON CONFLICT(id) DO UPDATE SET fingerprint=excluded.fingerprint, '
+                    'metadata=excluded.metadata',
+                    (str(wargamevault_id), fingerprint, metadata))
+
+    def evict(self):
+        with self.lock:
+            count = self.conn.execute('SELECT COUNT(*) FROM products').fetchone()[0]
+            excess = count - self.max_entries
+            if excess > 0:
+                self.conn.execute('DELETE FROM products WHERE id IN '
+                        '(SELECT id FROM products ORDER BY accessed ASC LIMIT ?)', (excess,))
+                self.conn.execute('DELETE FROM product_states WHERE id NOT IN '
+                        '(SELECT id FROM products)')
+
+    def clear(self):
+        with self.lock:
+            self.conn.execute('DELETE FROM products')
+            self.conn.execute('DELETE FROM product_states')
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM products').fetchone()[0]
+
+class CoverCache(object):
+
+    '''
+    Persistent cache of downloaded cover images keyed by cover URL. The ETag
+    and Last-Modified headers of each image are kept so that it can be
+    revalidated with a conditional request instead of downloaded again. Once
+    the images take up more than max_bytes the least recently used ones are
+    removed.
+    '''
+
+    def __init__(self, path, covers_dir, max_bytes=500*1024*1024):
+        self.covers_dir, self.max_bytes = covers_dir, max_bytes
+        if not os.path.exists(covers_dir):
+            os.makedirs(covers_dir)
+        self.lock = RLock()
+        self.conn = open_db(path)
+
+    def configure(self, max_bytes):
+        with self.lock:
+            self.max_bytes = max_bytes
+
+    def file_path(self, url):
+        return os.path.join(self.covers_dir,
+                hashlib.sha1(url.encode('utf-8')).hexdigest())
+
+    def get(self, url):
+        '''
+        Return (data, etag, last_modified) for a cached cover, or None
+        '''
+        with self.lock:
+            row = self.conn.execute('SELECT etag, last_modified FROM covers WHERE url=?',
+                    (url,)).fetchone()
+            if row is None:
+                return None
+            try:
+                with open(self.file_path(url), 'rb') as f:
+                    data = f.read()
+            except EnvironmentError:
+                self.conn.execute('DELETE FROM covers WHERE url=?', (url,))
+                return None
+            self.conn.execute('UPDATE covers SET accessed=? WHERE url=?', (time.time(), url))
+        return data, row[0], row[1]
+
+    def put(self, url, data, etag=None, last_modified=None):
+        if not data:
+            return
+        with self.lock:
+            with open(self.file_path(url), 'wb') as f:
+                f.write(data)
+            self.conn.execute('INSERT OR REPLACE INTO covers (url, etag, last_modified, size, accessed) '
+                    'VALUES (?, ?, ?, ?, ?)', (url, etag, last_modified, len(data), time.time()))
+            self.evict()
+
+    def evict(self):
+        with self.lock:
+            total = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM covers').fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            for url, size in self.conn.execute(
+                    'SELECT url, size FROM covers ORDER BY accessed ASC').fetchall():
+                if total <= self.max_bytes:
+                    break
+                self.conn.execute('DELETE FROM covers WHERE url=?', (url,))
+                try:
+                    os.remove(self.file_path(url))
+                except EnvironmentError:
+                    pass
+                total -= size
+
+    def clear(self):
+        with self.lock:
+            for (url,) in self.conn.execute('SELECT url FROM covers').fetchall():
+                try:
+                    os.remove(self.file_path(url))
+                except EnvironmentError:
+                    pass
+            self.conn.execute('DELETE FROM covers')
+
+class IsbnIndex(object):
+
+    '''
+    Persistent map from ISBN to the WarGameVault id of the product carrying it
+    '''
+
+    def __init__(self, path):
+        self.lock = RLock()
+        self.conn = open_db(path)
+
+    def normalize(self, isbn):
+        from calibre.ebooks.metadata import check_isbn
+        return check_isbn(isbn) or isbn.replace('-', '').replace(' ', '').upper()
+
+    def get(self, isbn):
+        if not isbn:
+            return None
+        with self.lock:
+            row = self.conn.execute('SELECT id FROM isbns WHERE isbn=?',
+                    (self.normalize(isbn),)).fetchone()
+        return row[0] if row else None
+
+    def put(self, isbn, wargamevault_id):
+        if not isbn or not wargamevault_id:
+            return
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO isbns (isbn, id) VALUES (?, ?)',
+                    (self.normalize(isbn), str(wargamevault_id)))
+
+class NegativeCache(object):
+
+    '''
+    Persistent record of lookups that found nothing: title searches with no
+    results and product ids that do not exist. Entries expire after ttl
+    seconds so that products added to WarGameVault are eventually found.
+    '''
+
+    def __init__(self, path, ttl=7*86400):
+        self.ttl = ttl
+        self.lock = RLock()
+        self.conn = open_db(path)
+
+    def configure(self, ttl):
+        with self.lock:
+            self.ttl = ttl
+
+    def search_key(self, title_tokens):
+        return 'search:' + ' '.join(t.lower() for t in title_tokens)
+
+    def product_key(self, wargamevault_id):
+        return 'product:%s'%wargamevault_id
+
+    def get(self, key):
+        with self.lock:
+            row = self.conn.execute('SELECT created FROM misses WHERE key=?', (key,)).fetchone()
+            if row is None:
+                return False
+            if time.time() - row[0] > self.ttl:
+                self.conn.execute('DELETE FROM misses WHERE key=?', (key,))
+                return False
+        return True
+
+    def put(self, key):
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO misses (key, created) VALUES (?, ?)',
+                    (key, time.time()))
+
+    def clear(self):
+        with self.lock:
+            self.conn.execute('DELETE FROM misses')
+
+_product_cache = None
+_cover_cache = None
+_isbn_index = None
+_negative_cache = None
+_cache_lock = RLock()
+
+def get_product_cache():
+    '''
+    Return the shared ProductCache configured from the plugin preferences, or
+    None if product caching has been disabled.
+    '''
+    global _product_cache
+    options = cfg.get_options()
+    if not options.get(cfg.KEY_CACHE_PRODUCTS):
+        return None
+    ttl = options.get(cfg.KEY_CACHE_TTL_DAYS) * 86400
+    max_entries = options.get(cfg.KEY_CACHE_MAX_ENTRIES)
+    with _cache_lock:
+        if _product_cache is None:
+            _product_cache = ProductCache(default_cache_path(), ttl, max_entries)
+        else:
+            _product_cache.configure(ttl, max_entries)
+        return _product_cache
+
+def get_cover_cache():
+    '''
+    Return the shared CoverCache configured from the plugin preferences, or
+    None if caching has been disabled.
+    '''
+    global _cover_cache
+    options = cfg.get_options()
+    if not options.get(cfg.KEY_CACHE_PRODUCTS):
+        return None
+    max_bytes = options.get(cfg.KEY_COVER_CACHE_MAX_MB) * 1024 * 1024
+    with _cache_lock:
+        if _cover_cache is None:
+            _cover_cache = CoverCache(default_cache_path(),
+                    os.path.join(default_cache_dir(), COVERS_DIR_NAME), max_bytes)
+        else:
+            _cover_cache.configure(max_bytes)
+        return _cover_cache
+
+def get_isbn_index():
+    '''
+    Return the shared IsbnIndex, or None if caching has been disabled.
+    '''
+    global _isbn_index
+    if not cfg.get_options().get(cfg.KEY_CACHE_PRODUCTS):
+        return None
+    with _cache_lock:
+        if _isbn_index is None:
+            _isbn_index = IsbnIndex(default_cache_path())
+        return _isbn_index
+
+def get_negative_cache():
+    '''
+    Return the shared NegativeCache, or None if caching or remembering
+    misses has been disabled.
+    '''
+    global _negative_cache
+    options = cfg.get_options()
+    ttl = options.get(cfg.KEY_NEGATIVE_CACHE_TTL_DAYS) * 86400
+    if not options.get(cfg.KEY_CACHE_PRODUCTS) or ttl <= 0:
+        return None
+    with _cache_lock:
+        if _negative_cache is None:
+            _negative_cache = NegativeCache(default_cache_path(), ttl)
+        else:
+            _negative_cache.configure(ttl)
+        return _negative_cache
+
+def clear_negative_cache():
+    '''
+    Forget every remembered miss, whether or not caching is enabled
+    '''
+    with _cache_lock:
+        cache = _negative_cache or NegativeCache(default_cache_path())
+        cache.clear()
+
+def use_cache_dir(path):
+    '''
+    Keep all caches in path from now on, or in calibre's cache directory if
+    path is None. Used by the benchmarks so they never touch the real cache.
+    '''
+    global _cache_dir_override, _product_cache, _cover_cache, _isbn_index, _negative_cache
+    with _cache_lock:
+        _cache_dir_override = path
+        _product_cache = _cover_cache = _isbn_index = _negative_cache = None
@@ -0,0 +1,228 @@
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+__license__   = 'GPL v3'
+
+'''
+Local full text index of WarGameVault products, used by identify to find
+candidates without a remote search.
+
+The index is filled from every product the plugin downloads, back-filled from
+the product cache, and can be bulk loaded from a catalog file:
+
+    calibre-debug -e catalog.py -- import catalog.jsonl
+
+where each line is either a /products/<id> API response or an object with
+id, name, authors, publisher and isbn keys.
+'''
+
+import sys
+import json
+import sqlite3
+from threading import RLock
+
+if __name__ == '__main__':
+    # Loading the installed plugins is what makes calibre_plugins importable
+    from calibre.customize.ui import initialized_plugins
+    initialized_plugins()
+
+import calibre_plugins.wargamevault.config as cfg
+from calibre_plugins.wargamevault.cache import default_cache_path, open_db
+from calibre_plugins.wargamevault.product import ProductRecord
+
+SCHEMA = '''
+CREATE VIRTUAL TABLE IF NOT EXISTS catalog USING fts5 (
+    id UNINDEXED, name, authors, publisher, isbn,
+    tokenize = 'unicode61 remove_diacritics 2'
+);
+CREATE TABLE IF NOT EXISTS catalog_ids (
+    id TEXT PRIMARY KEY,
+    docid INTEGER
+);
+'''
+
+# Cached products indexed per transaction when back-filling the index
+SYNC_BATCH_SIZE = 200
+
+def fts_query(column, tokens):
+    # Every token must appear in the column; quoting stops tokens being read
+    # as FTS operators
+    terms = ['"%s"'%t.replace('"', '""') for t in tokens if t]
+    if not terms:
+        return None
+    return '%s : (%s)'%(column, ' AND '.join(terms))
+
+class CatalogIndex(object):
+
+    '''
+    SQLite FTS5 index of product id, name, authors, publisher and ISBN.
+
+    The FTS table cannot look rows up by id, so catalog_ids maps each product
+    id seen to the rowid of its catalog row, or to NULL for cached products
+    with nothing to index.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = RLock()
+        self.conn = open_db(path)
+        self.synced = False
+        try:
+            self.conn.executescript(SCHEMA)
+            self.available = True
+        except sqlite3.OperationalError:
+            # SQLite built without FTS5
+            self.available = False
+
+    def add(self, wargamevault_id, record):
+        if not self.available:
+            return
+        self.add_fields(wargamevault_id, record.name, record.authors,
+                record.publisher, record.isbn)
+
+    def add_fields(self, wargamevault_id, name, authors=(), publisher=None, isbn=None):
+        if not self.available or not name:
+            return
+        key = str(wargamevault_id)
+        with self.lock:
+            # A transaction that reads before writing cannot wait for the
+            # write lock if another connection writes in between, so one is
+            # taken up front unless the caller already holds it
+            nested = self.conn.in_transaction
+            self.conn.execute('SAVEPOINT catalog_add' if nested else 'BEGIN IMMEDIATE')
+            try:
+                row = self.conn.execute('SELECT docid FROM catalog_ids WHERE id=?',
+                        (key,)).fetchone()
+                if row is not None and row[0] is not None:
+                    self.conn.execute('DELETE FROM catalog WHERE rowid=?', (row[0],))
+                docid = self.conn.execute('INSERT INTO catalog (id, name, authors, publisher, isbn) '
+                        'VALUES (?, ?, ?, ?, ?)', (key, name, ' ; '.join(authors or ()),
+                            publisher or '', isbn or '')).lastrowid
+                self.conn.execute('INSERT OR REPLACE INTO catalog_ids (id, docid) VALUES (?, ?)',
+                        (key, docid))
+            except:
+                if nested:
+                    self.conn.execute('ROLLBACK TO catalog_add')
+                    self.conn.execute('RELEASE catalog_add')
+                else:
+                    self.conn.execute('ROLLBACK')
+                raise
+            self.conn.execute('RELEASE catalog_add' if nested else 'COMMIT')
+
+    def sync_from_product_cache(self, abort=None):
+        '''
+        Index every cached product that is not in the index yet, a batch at a
+        time so that other threads can use the index in between. Stops early,
+        leaving the rest for next time, once abort is set.
+        '''
+        if not self.available:
+            return 0
+        count = 0
+        while not self.synced:
+            if abort is not None and abort.is_set():
+                break
+            with self.lock:
+                rows = self.conn.execute('SELECT p.id, p.raw FROM products p WHERE NOT EXISTS '
+                        '(SELECT 1 FROM catalog_ids c WHERE c.id = p.id) LIMIT ?',
+                        (SYNC_BATCH_SIZE,)).fetchall()
+                self.conn.execute('BEGIN IMMEDIATE')
+                try:
+                    for key, raw in rows:
+                        try:
+                            record = ProductRecord.from_json(raw)
+                        except Exception:
+                            record = None
+                        if record is not None:
+                            self.add(key, record)
+                            count += 1
+                        # Products with nothing to index are not looked at again
+                        self.conn.execute('INSERT OR IGNORE INTO catalog_ids (id, docid) '
+                                'VALUES (?, NULL)', (key,))
+                except:
+                    self.conn.execute('ROLLBACK')
+                    raise
+                self.conn.execute('COMMIT')
+                if len(rows) < SYNC_BATCH_SIZE:
+                    self.synced = True
+        return count
+
+    def import_catalog(self, stream):
+        '''
+        Bulk load products from an iterable of JSON lines
+        '''
+        count = 0
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                for line in stream:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    data = json.loads(line)
+                    if 'data' in data:
+                        self.add(data['data']['attributes']['productId'],
+                                ProductRecord.from_data(data))
+                    else:
+                        self.add_fields(data['id'], data.get('name'), data.get('authors'),
+                                data.get('publisher'), data.get('isbn'))
+                    count += 1
+            except:
+                self.conn.execute('ROLLBACK')
+                raise
+            self.conn.execute('COMMIT')
+        return count
+
+    def search(self, title_tokens, author_tokens=(), limit=6, abort=None):
+        '''
+        Return (id, name, authors) for products whose name contains every
+        title token, best match first. Matching authors break ties between
+        equally good names. Cached products not indexed yet are added first,
+        until abort is set.
+        '''
+        if not self.available:
+            return []
+        query = fts_query('name', title_tokens)
+        if query is None:
+            return []
+        self.sync_from_product_cache(abort)
+        with self.lock:
+            rows = self.conn.execute('SELECT id, name, authors, bm25(catalog) FROM catalog '
+                    'WHERE catalog MATCH ? ORDER BY bm25(catalog) LIMIT ?',
+                    (query, limit * 4)).fetchall()
+        author_tokens = {t.lower() for t in author_tokens}
+        def rank(row):
+            authors = set(row[2].lower().replace(';', ' ').split())
+            return (-len(author_tokens & authors), row[3])
+        return [(row[0], row[1], [a for a in row[2].split(' ; ') if a])
+                for row in sorted(rows, key=rank)[:limit]]
+
+_catalog_index = None
+_catalog_lock = RLock()
+
+def get_catalog_index():
+    '''
+    Return the shared CatalogIndex, or None if the local index is disabled
+    '''
+    global _catalog_index
+    if not cfg.get_options().get(cfg.KEY_USE_LOCAL_INDEX):
+        return None
+    path = default_cache_path()
+    with _catalog_lock:
+        if _catalog_index is None or _catalog_index.path != path:
+            _catalog_index = CatalogIndex(path)
+        return _catalog_index
+
+def main(args=sys.argv[1:]):
+    if len(args) != 2 or args[0] != 'import':
+        print('Usage: calibre-debug -e catalog.py -- import catalog.jsonl')
+        return 1
+    index = CatalogIndex(default_cache_path())
+    if not index.available:
+        print('This SQLite does not support full text search')
+        return 1
+    with open(args[1], 'rb') as f:
+        count = index.import_catalog(line.decode('utf-8') for line in f)
+    print('Imported %d products into the WarGameVault catalog index'%count)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,18 +2,13 @@ from __future__ import unicode_literals, division, absolute_import, print_functi
 
 __license__   = 'GPL v3'
 
-try:
-    from qt.core import (QVBoxLayout, Qt, QGroupBox, QCheckBox)
-except:
-    from PyQt5.Qt import (QVBoxLayout, Qt, QGroupBox, QCheckBox)
+# Nothing here may import Qt or touch the disk when the module is imported:
+# it is loaded by every calibre worker process that downloads metadata.
+# plugin_prefs is only read from disk on first use, and ConfigWidget lives in
+# config_widget.py.
 
-try:
-    load_translations()
-except NameError:
-    pass # load_translations() added in calibre 1.9
-
-from calibre.gui2.metadata.config import ConfigWidget as DefaultConfigWidget
-from calibre.utils.config import JSONConfig
+from threading import Lock
+from types import MappingProxyType
 
 STORE_NAME = 'Options'
 KEY_GET_CATEGORY_AS_TAGS          = 'getCategoryAsTags'
@@ -21,6 +16,21 @@ KEY_GET_FILTER_AS_TAGS            = 'getFilterAsTags'
 KEY_GET_ARTISTS_AS_AUTHORS        = 'getArtistsAsAuthors'
 KEY_GET_EDITORS_AS_AUTHORS        = 'getEditorsAsAuthors'
 KEY_GET_CONTRIBUTORS_AS_AUTHORS   = 'getContributorsAsAuthors'
+KEY_CACHE_PRODUCTS                = 'cacheProducts'
+KEY_CACHE_TTL_DAYS                = 'cacheTtlDays'
+KEY_CACHE_MAX_ENTRIES             = 'cacheMaxEntries'
+KEY_COVER_CACHE_MAX_MB            = 'coverCacheMaxMb'
+KEY_MAX_CONCURRENCY               = 'maxConcurrency'
+KEY_MAX_REQUEST_RATE              = 'maxRequestRate'
+KEY_LOG_METRICS                   = 'logMetrics'
+KEY_USE_LOCAL_INDEX               = 'useLocalIndex'
+KEY_MIN_CANDIDATE_SCORE           = 'minCandidateScore'
+KEY_STOP_ON_EXACT_MATCH           = 'stopOnExactMatch'
+KEY_USE_ASYNC_ENGINE              = 'useAsyncEngine'
+KEY_INCREMENTAL_REFRESH           = 'incrementalRefresh'
+KEY_NEGATIVE_CACHE_TTL_DAYS       = 'negativeCacheTtlDays'
+KEY_SEARCH_PAGES                  = 'searchPages'
+KEY_METRICS_FILE                  = 'metricsFile'
 
 DEFAULT_STORE_VALUES = {
     KEY_GET_CATEGORY_AS_TAGS: True,
@@ -28,68 +38,88 @@ DEFAULT_STORE_VALUES = {
     KEY_GET_ARTISTS_AS_AUTHORS: False,
     KEY_GET_EDITORS_AS_AUTHORS: False,
     KEY_GET_CONTRIBUTORS_AS_AUTHORS: False,
+    KEY_CACHE_PRODUCTS: True,
+    KEY_CACHE_TTL_DAYS: 30,
+    KEY_CACHE_MAX_ENTRIES: 20000,
+    KEY_COVER_CACHE_MAX_MB: 500,
+    KEY_MAX_CONCURRENCY: 6,
+    KEY_MAX_REQUEST_RATE: 100,
+    KEY_LOG_METRICS: False,
+    KEY_USE_LOCAL_INDEX: False,
+    KEY_MIN_CANDIDATE_SCORE: 30,
+    KEY_STOP_ON_EXACT_MATCH: True,
+    KEY_USE_ASYNC_ENGINE: False,
+    KEY_INCREMENTAL_REFRESH: False,
+    KEY_NEGATIVE_CACHE_TTL_DAYS: 7,
+    KEY_SEARCH_PAGES: 1,
+    KEY_METRICS_FILE: '',
 }
 
 # This is where all preferences for this plugin will be stored
-plugin_prefs = JSONConfig('plugins/WarGameVault')
-
-# Set defaults
-plugin_prefs.defaults[STORE_NAME] = DEFAULT_STORE_VALUES
+_plugin_prefs = None
+_plugin_prefs_lock = Lock()
+
+def get_plugin_prefs():
+    global _plugin_prefs
+    with _plugin_prefs_lock:
+        if _plugin_prefs is None:
+            from calibre.utils.config import JSONConfig
+            prefs = JSONConfig('plugins/WarGameVault')
+            # Set defaults
+            prefs.defaults[STORE_NAME] = DEFAULT_STORE_VALUES
+            _plugin_prefs = prefs
+        return _plugin_prefs
+
+def __getattr__(name):
+    # Keeps config.plugin_prefs and config.ConfigWidget working without
+    # paying for them at import time
+    if name == 'plugin_prefs':
+        return get_plugin_prefs()
+    if name == 'ConfigWidget':
+        from calibre_plugins.wargamevault.config_widget import ConfigWidget
+        return ConfigWidget
+    raise AttributeError('module %r has no attribute %r'%(__name__, name))
 
 def get_option(option_name):
-    return plugin_prefs[STORE_NAME].get(option_name, DEFAULT_STORE_VALUES[option_name])
-
-class ConfigWidget(DefaultConfigWidget):
-
-    def __init__(self, plugin):
-        DefaultConfigWidget.__init__(self, plugin)
-        c = plugin_prefs[STORE_NAME]
-
-        other_group_box = QGroupBox(_('Other options'), self)
-        self.l.addWidget(other_group_box, self.l.rowCount(), 0, 1, 2)
-        other_group_box_layout = QVBoxLayout()
-        other_group_box.setLayout(other_group_box_layout)
-
-        self.get_category_as_tags_checkbox = QCheckBox(_('Include \'Categories\' in the Tags column'), self)
-        self.get_category_as_tags_checkbox.setToolTip(_('When checked, if a book has any categories defined they will be\n'
-                                                   'returned in the Tags column from this plugin.'))
-        self.get_category_as_tags_checkbox.setChecked(get_option(KEY_GET_CATEGORY_AS_TAGS))
-        other_group_box_layout.addWidget(self.get_category_as_tags_checkbox)
-
-        self.get_filter_as_tags_checkbox = QCheckBox(_('Include \'Filters\' in the Tags column'), self)
-        self.get_filter_as_tags_checkbox.setToolTip(_('When checked, if a book has any Filters defined it will be\n'
-                                                         'returned in the Tags column from this plugin.'))
-        self.get_filter_as_tags_checkbox.setChecked(get_option(KEY_GET_FILTER_AS_TAGS))
-        other_group_box_layout.addWidget(self.get_filter_as_tags_checkbox)
-
-        self.get_artists_as_authors_checkbox = QCheckBox(_('Include \'Artists\' in the Author(s) field'), self)
-        self.get_artists_as_authors_checkbox.setToolTip(_('When checked, if a book has any Artists defined\n'
-                                                         'they will be added to the Author(s) field.'))
-        self.get_artists_as_authors_checkbox.setChecked(get_option(KEY_GET_ARTISTS_AS_AUTHORS))
-        other_group_box_layout.addWidget(self.get_artists_as_authors_checkbox)
-
-        self.get_editors_as_authors_checkbox = QCheckBox(_('Include \'Editors\' in the Author(s) field'), self)
-        self.get_editors_as_authors_checkbox.setToolTip(_('When checked, if a book has any Editors defined\n'
-                                                         'they will be added to the Author(s) field.'))
-        self.get_editors_as_authors_checkbox.setChecked(get_option(KEY_GET_EDITORS_AS_AUTHORS))
-        other_group_box_layout.addWidget(self.get_editors_as_authors_checkbox)
-
-        self.get_contributors_as_authors_checkbox = QCheckBox(_('Include \'Contributors\' in the Author(s) field'), self)
-        self.get_contributors_as_authors_checkbox.setToolTip(_('When checked, if a book has any Contributors defined\n'
-                                                         'they will be added to the Author(s) field.'))
-        self.get_contributors_as_authors_checkbox.setChecked(get_option(KEY_GET_CONTRIBUTORS_AS_AUTHORS))
-        other_group_box_layout.addWidget(self.get_contributors_as_authors_checkbox)
-
-        other_group_box_layout.addStretch(1)
-
-    def commit(self):
-        DefaultConfigWidget.commit(self)
-
-        new_prefs = {}
-        new_prefs[KEY_GET_CATEGORY_AS_TAGS] = self.get_category_as_tags_checkbox.checkState() == Qt.Checked
-        new_prefs[KEY_GET_FILTER_AS_TAGS] = self.get_filter_as_tags_checkbox.checkState() == Qt.Checked
-        new_prefs[KEY_GET_ARTISTS_AS_AUTHORS] = self.get_artists_as_authors_checkbox.checkState() == Qt.Checked
-        new_prefs[KEY_GET_EDITORS_AS_AUTHORS] = self.get_editors_as_authors_checkbox.checkState() == Qt.Checked
-        new_prefs[KEY_GET_CONTRIBUTORS_AS_AUTHORS] = self.get_contributors_as_authors_checkbox.checkState() == Qt.Checked
-
-        plugin_prefs[STORE_NAME] = new_prefs
+    return get_plugin_prefs()[STORE_NAME].get(option_name, DEFAULT_STORE_VALUES[option_name])
+
+# Incremented each time ConfigWidget.commit writes new preferences, so the
+# snapshot from get_options is only rebuilt when something actually changed
+prefs_version = 0
+_options = None
+_options_lock = Lock()
+
+class Options(object):
+
+    '''
+    Read only snapshot of the plugin preferences, taken once per identify so
+    that Workers never go back to the JSONConfig while parsing results
+    '''
+
+    __slots__ = ('version', 'values')
+
+    def __init__(self, version, values):
+        object.__setattr__(self, 'version', version)
+        object.__setattr__(self, 'values', MappingProxyType(dict(values)))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Options snapshots are read only')
+
+    def get(self, option_name):
+        return self.values.get(option_name, DEFAULT_STORE_VALUES[option_name])
+
+def get_options():
+    global _options
+    with _options_lock:
+        if _options is None or _options.version != prefs_version:
+            _options = Options(prefs_version, get_plugin_prefs()[STORE_NAME])
+        return _options
+
+def set_prefs(new_prefs):
+    '''
+    Store new preferences and invalidate the get_options snapshot
+    '''
+    global prefs_version
+    with _options_lock:
+        get_plugin_prefs()[STORE_NAME] = new_prefs
+        prefs_version += 1
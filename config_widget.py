@@ -0,0 +1,282 @@
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+__license__   = 'GPL v3'
+
+try:
+    from qt.core import (QVBoxLayout, QHBoxLayout, Qt, QGroupBox, QCheckBox,
+                         QLabel, QSpinBox, QPushButton, QLineEdit)
+except:
+    from PyQt5.Qt import (QVBoxLayout, QHBoxLayout, Qt, QGroupBox, QCheckBox,
+                          QLabel, QSpinBox, QPushButton, QLineEdit)
+
+try:
+    load_translations()
+except NameError:
+    pass # load_translations() added in calibre 1.9
+
+from calibre.gui2.metadata.config import ConfigWidget as DefaultConfigWidget
+
+from calibre_plugins.wargamevault.config import (STORE_NAME, KEY_CACHE_MAX_ENTRIES,
+        KEY_CACHE_PRODUCTS, KEY_CACHE_TTL_DAYS, KEY_COVER_CACHE_MAX_MB,
+        KEY_GET_ARTISTS_AS_AUTHORS, KEY_GET_CATEGORY_AS_TAGS,
+        KEY_GET_CONTRIBUTORS_AS_AUTHORS, KEY_GET_EDITORS_AS_AUTHORS,
+        KEY_GET_FILTER_AS_TAGS, KEY_INCREMENTAL_REFRESH, KEY_LOG_METRICS,
+        KEY_MAX_CONCURRENCY, KEY_MAX_REQUEST_RATE, KEY_METRICS_FILE, KEY_MIN_CANDIDATE_SCORE,
+        KEY_NEGATIVE_CACHE_TTL_DAYS, KEY_SEARCH_PAGES, KEY_STOP_ON_EXACT_MATCH,
+        KEY_USE_ASYNC_ENGINE, KEY_USE_LOCAL_INDEX,
+        get_option, get_plugin_prefs, set_prefs)
+
+class ConfigWidget(DefaultConfigWidget):
+
+    def __init__(self, plugin):
+        DefaultConfigWidget.__init__(self, plugin)
+        c = get_plugin_prefs()[STORE_NAME]
+
+        other_group_box = QGroupBox(_('Other options'), self)
+        self.l.addWidget(other_group_box, self.l.rowCount(), 0, 1, 2)
+        other_group_box_layout = QVBoxLayout()
+        other_group_box.setLayout(other_group_box_layout)
+
+        self.get_category_as_tags_checkbox = QCheckBox(_('Include \'Categories\' in the Tags column'), self)
+        self.get_category_as_tags_checkbox.setToolTip(_('When checked, if a book has any categories defined they will be\n'
+                                                   'returned in the Tags column from this plugin.'))
+        self.get_category_as_tags_checkbox.setChecked(get_option(KEY_GET_CATEGORY_AS_TAGS))
+        other_group_box_layout.addWidget(self.get_category_as_tags_checkbox)
+
+        self.get_filter_as_tags_checkbox = QCheckBox(_('Include \'Filters\' in the Tags column'), self)
+        self.get_filter_as_tags_checkbox.setToolTip(_('When checked, if a book has any Filters defined it will be\n'
+                                                         'returned in the Tags column from this plugin.'))
+        self.get_filter_as_tags_checkbox.setChecked(get_option(KEY_GET_FILTER_AS_TAGS))
+        other_group_box_layout.addWidget(self.get_filter_as_tags_checkbox)
+
+        self.get_artists_as_authors_checkbox = QCheckBox(_('Include \'Artists\' in the Author(s) field'), self)
+        self.get_artists_as_authors_checkbox.setToolTip(_('When checked, if a book has any Artists defined\n'
+                                                         'they will be added to the Author(s) field.'))
+        self.get_artists_as_authors_checkbox.setChecked(get_option(KEY_GET_ARTISTS_AS_AUTHORS))
+        other_group_box_layout.addWidget(self.get_artists_as_authors_checkbox)
+
+        self.get_editors_as_authors_checkbox = QCheckBox(_('Include \'Editors\' in the Author(s) field'), self)
+        self.get_editors_as_authors_checkbox.setToolTip(_('When checked, if a book has any Editors defined\n'
+                                                         'they will be added to the Author(s) field.'))
+        self.get_editors_as_authors_checkbox.setChecked(get_option(KEY_GET_EDITORS_AS_AUTHORS))
+        other_group_box_layout.addWidget(self.get_editors_as_authors_checkbox)
+
+        self.get_contributors_as_authors_checkbox = QCheckBox(_('Include \'Contributors\' in the Author(s) field'), self)
+        self.get_contributors_as_authors_checkbox.setToolTip(_('When checked, if a book has any Contributors defined\n'
+                                                         'they will be added to the Author(s) field.'))
+        self.get_contributors_as_authors_checkbox.setChecked(get_option(KEY_GET_CONTRIBUTORS_AS_AUTHORS))
+        other_group_box_layout.addWidget(self.get_contributors_as_authors_checkbox)
+
+        candidate_score_layout = QHBoxLayout()
+        candidate_score_label = QLabel(_('Minimum title match for search results (%):'), self)
+        candidate_score_label.setToolTip(_('Search results whose title shares less than this much with the book\n'
+                                           'are skipped without downloading their details. Set to 0 to download\n'
+                                           'every search result.'))
+        self.min_candidate_score_spinbox = QSpinBox(self)
+        self.min_candidate_score_spinbox.setRange(0, 100)
+        self.min_candidate_score_spinbox.setValue(get_option(KEY_MIN_CANDIDATE_SCORE))
+        candidate_score_label.setBuddy(self.min_candidate_score_spinbox)
+        candidate_score_layout.addWidget(candidate_score_label)
+        candidate_score_layout.addWidget(self.min_candidate_score_spinbox)
+        candidate_score_layout.addStretch(1)
+        other_group_box_layout.addLayout(candidate_score_layout)
+
+        search_pages_layout = QHBoxLayout()
+        search_pages_label = QLabel(_('Pages of search results to check:'), self)
+        search_pages_label.setToolTip(_('Each page holds six products. Extra pages are fetched at the same\n'
+                                        'time as the first, and matches on the first page are downloaded\n'
+                                        'without waiting for them.'))
+        self.search_pages_spinbox = QSpinBox(self)
+        self.search_pages_spinbox.setRange(1, 5)
+        self.search_pages_spinbox.setValue(get_option(KEY_SEARCH_PAGES))
+        search_pages_label.setBuddy(self.search_pages_spinbox)
+        search_pages_layout.addWidget(search_pages_label)
+        search_pages_layout.addWidget(self.search_pages_spinbox)
+        search_pages_layout.addStretch(1)
+        other_group_box_layout.addLayout(search_pages_layout)
+
+        self.stop_on_exact_match_checkbox = QCheckBox(_('Stop after finding an exact title match'), self)
+        self.stop_on_exact_match_checkbox.setToolTip(_('When checked, once a search result with exactly the book\'s title (and\n'
+                                                       'a matching author) has been found, the remaining results are skipped.\n'
+                                                       'Uncheck this if you keep more than one entry per source.'))
+        self.stop_on_exact_match_checkbox.setChecked(get_option(KEY_STOP_ON_EXACT_MATCH))
+        other_group_box_layout.addWidget(self.stop_on_exact_match_checkbox)
+
+        other_group_box_layout.addStretch(1)
+
+        cache_group_box = QGroupBox(_('Cache options'), self)
+        self.l.addWidget(cache_group_box, self.l.rowCount(), 0, 1, 2)
+        cache_group_box_layout = QVBoxLayout()
+        cache_group_box.setLayout(cache_group_box_layout)
+
+        self.cache_products_checkbox = QCheckBox(_('Cache downloaded product details and covers on disk'), self)
+        self.cache_products_checkbox.setToolTip(_('When checked, product details and covers fetched from WarGameVault\n'
+                                                  'are kept on disk and reused instead of being downloaded again.'))
+        self.cache_products_checkbox.setChecked(get_option(KEY_CACHE_PRODUCTS))
+        cache_group_box_layout.addWidget(self.cache_products_checkbox)
+
+        cache_ttl_layout = QHBoxLayout()
+        cache_ttl_label = QLabel(_('Keep cached products for (days):'), self)
+        cache_ttl_label.setToolTip(_('Cached product details older than this are downloaded again.\n'
+                                     'Set to 0 to keep them until they are evicted.'))
+        self.cache_ttl_spinbox = QSpinBox(self)
+        self.cache_ttl_spinbox.setRange(0, 3650)
+        self.cache_ttl_spinbox.setValue(get_option(KEY_CACHE_TTL_DAYS))
+        cache_ttl_label.setBuddy(self.cache_ttl_spinbox)
+        cache_ttl_layout.addWidget(cache_ttl_label)
+        cache_ttl_layout.addWidget(self.cache_ttl_spinbox)
+        cache_ttl_layout.addStretch(1)
+        cache_group_box_layout.addLayout(cache_ttl_layout)
+
+        cache_size_layout = QHBoxLayout()
+        cache_size_label = QLabel(_('Maximum number of cached products:'), self)
+        cache_size_label.setToolTip(_('When the cache grows beyond this many products the least\n'
+                                      'recently used ones are removed.'))
+        self.cache_max_entries_spinbox = QSpinBox(self)
+        self.cache_max_entries_spinbox.setRange(100, 1000000)
+        self.cache_max_entries_spinbox.setSingleStep(1000)
+        self.cache_max_entries_spinbox.setValue(get_option(KEY_CACHE_MAX_ENTRIES))
+        cache_size_label.setBuddy(self.cache_max_entries_spinbox)
+        cache_size_layout.addWidget(cache_size_label)
+        cache_size_layout.addWidget(self.cache_max_entries_spinbox)
+        cache_size_layout.addStretch(1)
+        cache_group_box_layout.addLayout(cache_size_layout)
+
+        cover_cache_size_layout = QHBoxLayout()
+        cover_cache_size_label = QLabel(_('Maximum size of cached covers (MB):'), self)
+        cover_cache_size_label.setToolTip(_('When cached covers take up more space than this the least\n'
+                                            'recently used ones are removed.'))
+        self.cover_cache_max_mb_spinbox = QSpinBox(self)
+        self.cover_cache_max_mb_spinbox.setRange(10, 100000)
+        self.cover_cache_max_mb_spinbox.setSingleStep(100)
+        self.cover_cache_max_mb_spinbox.setValue(get_option(KEY_COVER_CACHE_MAX_MB))
+        cover_cache_size_label.setBuddy(self.cover_cache_max_mb_spinbox)
+        cover_cache_size_layout.addWidget(cover_cache_size_label)
+        cover_cache_size_layout.addWidget(self.cover_cache_max_mb_spinbox)
+        cover_cache_size_layout.addStretch(1)
+        cache_group_box_layout.addLayout(cover_cache_size_layout)
+
+        negative_cache_layout = QHBoxLayout()
+        negative_cache_label = QLabel(_('Remember searches and products not found for (days):'), self)
+        negative_cache_label.setToolTip(_('Title searches with no results and products that do not exist are not\n'
+                                          'tried again for this long. Set to 0 to always try again.'))
+        self.negative_cache_ttl_spinbox = QSpinBox(self)
+        self.negative_cache_ttl_spinbox.setRange(0, 365)
+        self.negative_cache_ttl_spinbox.setValue(get_option(KEY_NEGATIVE_CACHE_TTL_DAYS))
+        negative_cache_label.setBuddy(self.negative_cache_ttl_spinbox)
+        negative_cache_layout.addWidget(negative_cache_label)
+        negative_cache_layout.addWidget(self.negative_cache_ttl_spinbox)
+        self.clear_negative_cache_button = QPushButton(_('Forget'), self)
+        self.clear_negative_cache_button.setToolTip(_('Forget the searches and products that were not found,\n'
+                                                      'so they are tried again next time.'))
+        self.clear_negative_cache_button.clicked.connect(self.clear_negative_cache)
+        negative_cache_layout.addWidget(self.clear_negative_cache_button)
+        negative_cache_layout.addStretch(1)
+        cache_group_box_layout.addLayout(negative_cache_layout)
+
+        self.use_local_index_checkbox = QCheckBox(_('Search a local index of known products before searching WarGameVault'), self)
+        self.use_local_index_checkbox.setToolTip(_('When checked, products that have been downloaded or imported are indexed\n'
+                                                   'on disk, and searches by title look there first. WarGameVault is still\n'
+                                                   'searched, and its results ranked with the local ones, unless the local\n'
+                                                   'index has an exact match.'))
+        self.use_local_index_checkbox.setChecked(get_option(KEY_USE_LOCAL_INDEX))
+        cache_group_box_layout.addWidget(self.use_local_index_checkbox)
+
+        self.incremental_refresh_checkbox = QCheckBox(_('Only re-process products that changed since they were last downloaded'), self)
+        self.incremental_refresh_checkbox.setToolTip(_('When checked, the metadata found for each product is kept with the\n'
+                                                       'cached product. Products are re-checked with conditional requests and,\n'
+                                                       'if they have not changed, the kept metadata is returned as is. This\n'
+                                                       'makes re-downloading metadata for an already tagged library much quicker.'))
+        self.incremental_refresh_checkbox.setChecked(get_option(KEY_INCREMENTAL_REFRESH))
+        cache_group_box_layout.addWidget(self.incremental_refresh_checkbox)
+
+        network_group_box = QGroupBox(_('Network options'), self)
+        self.l.addWidget(network_group_box, self.l.rowCount(), 0, 1, 2)
+        network_group_box_layout = QVBoxLayout()
+        network_group_box.setLayout(network_group_box_layout)
+
+        concurrency_layout = QHBoxLayout()
+        concurrency_label = QLabel(_('Maximum simultaneous product downloads:'), self)
+        concurrency_label.setToolTip(_('The number of product details downloaded from WarGameVault at the\n'
+                                       'same time, shared across all books being identified.'))
+        self.max_concurrency_spinbox = QSpinBox(self)
+        self.max_concurrency_spinbox.setRange(1, 32)
+        self.max_concurrency_spinbox.setValue(get_option(KEY_MAX_CONCURRENCY))
+        concurrency_label.setBuddy(self.max_concurrency_spinbox)
+        concurrency_layout.addWidget(concurrency_label)
+        concurrency_layout.addWidget(self.max_concurrency_spinbox)
+        concurrency_layout.addStretch(1)
+        network_group_box_layout.addLayout(concurrency_layout)
+
+        request_rate_layout = QHBoxLayout()
+        request_rate_label = QLabel(_('Maximum requests per second:'), self)
+        request_rate_label.setToolTip(_('The fastest rate requests are sent to WarGameVault at, shared across\n'
+                                        'all books being identified. The rate starts lower and speeds up while\n'
+                                        'requests succeed, slowing down again when WarGameVault asks it to\n'
+                                        'or requests fail.'))
+        self.max_request_rate_spinbox = QSpinBox(self)
+        self.max_request_rate_spinbox.setRange(1, 1000)
+        self.max_request_rate_spinbox.setValue(get_option(KEY_MAX_REQUEST_RATE))
+        request_rate_label.setBuddy(self.max_request_rate_spinbox)
+        request_rate_layout.addWidget(request_rate_label)
+        request_rate_layout.addWidget(self.max_request_rate_spinbox)
+        request_rate_layout.addStretch(1)
+        network_group_box_layout.addLayout(request_rate_layout)
+
+        self.log_metrics_checkbox = QCheckBox(_('Write a timing summary to the log after each search'), self)
+        self.log_metrics_checkbox.setToolTip(_('When checked, a line of the timings, cache hits and retry counts of\n'
+                                               'each search is added to the metadata download log.'))
+        self.log_metrics_checkbox.setChecked(get_option(KEY_LOG_METRICS))
+        network_group_box_layout.addWidget(self.log_metrics_checkbox)
+
+        metrics_file_layout = QHBoxLayout()
+        metrics_file_label = QLabel(_('Write timings as JSON to file:'), self)
+        metrics_file_label.setToolTip(_('When set, the timings and counts of the last search and the totals\n'
+                                        'for this session are written to this file after each search.\n'
+                                        'Leave empty to not write them.'))
+        self.metrics_file_edit = QLineEdit(self)
+        self.metrics_file_edit.setText(get_option(KEY_METRICS_FILE))
+        metrics_file_label.setBuddy(self.metrics_file_edit)
+        metrics_file_layout.addWidget(metrics_file_label)
+        metrics_file_layout.addWidget(self.metrics_file_edit, 1)
+        network_group_box_layout.addLayout(metrics_file_layout)
+
+        self.use_async_engine_checkbox = QCheckBox(_('Download over shared keep-alive connections'), self)
+        self.use_async_engine_checkbox.setToolTip(_('When checked, searches, product details and covers are downloaded\n'
+                                                    'by a single background network thread that reuses compressed\n'
+                                                    'connections to WarGameVault, instead of one browser per download.\n'
+                                                    'Proxy settings made in calibre are not used in this mode.'))
+        self.use_async_engine_checkbox.setChecked(get_option(KEY_USE_ASYNC_ENGINE))
+        network_group_box_layout.addWidget(self.use_async_engine_checkbox)
+
+    def clear_negative_cache(self):
+        from calibre_plugins.wargamevault.cache import clear_negative_cache
+        clear_negative_cache()
+        self.clear_negative_cache_button.setEnabled(False)
+
+    def commit(self):
+        DefaultConfigWidget.commit(self)
+
+        new_prefs = {}
+        new_prefs[KEY_GET_CATEGORY_AS_TAGS] = self.get_category_as_tags_checkbox.checkState() == Qt.Checked
+        new_prefs[KEY_GET_FILTER_AS_TAGS] = self.get_filter_as_tags_checkbox.checkState() == Qt.Checked
+        new_prefs[KEY_GET_ARTISTS_AS_AUTHORS] = self.get_artists_as_authors_checkbox.checkState() == Qt.Checked
+        new_prefs[KEY_GET_EDITORS_AS_AUTHORS] = self.get_editors_as_authors_checkbox.checkState() == Qt.Checked
+        new_prefs[KEY_GET_CONTRIBUTORS_AS_AUTHORS] = self.get_contributors_as_authors_checkbox.checkState() == Qt.Checked
+        new_prefs[KEY_CACHE_PRODUCTS] = self.cache_products_checkbox.checkState() == Qt.Checked
+        new_prefs[KEY_CACHE_TTL_DAYS] = self.cache_ttl_spinbox.value()
+        new_prefs[KEY_CACHE_MAX_ENTRIES] = self.cache_max_entries_spinbox.value()
+        new_prefs[KEY_COVER_CACHE_MAX_MB] = self.cover_cache_max_mb_spinbox.value()
+        new_prefs[KEY_NEGATIVE_CACHE_TTL_DAYS] = self.negative_cache_ttl_spinbox.value()
+        new_prefs[KEY_MAX_CONCURRENCY] = self.max_concurrency_spinbox.value()
+        new_prefs[KEY_MAX_REQUEST_RATE] = self.max_request_rate_spinbox.value()
+        new_prefs[KEY_LOG_METRICS] = self.log_metrics_checkbox.checkState() == Qt.Checked
+        new_prefs[KEY_METRICS_FILE] = self.metrics_file_edit.text().strip()
+        new_prefs[KEY_USE_LOCAL_INDEX] = self.use_local_index_checkbox.checkState() == Qt.Checked
+        new_prefs[KEY_MIN_CANDIDATE_SCORE] = self.min_candidate_score_spinbox.value()
+        new_prefs[KEY_SEARCH_PAGES] = self.search_pages_spinbox.value()
+        new_prefs[KEY_STOP_ON_EXACT_MATCH] = self.stop_on_exact_match_checkbox.checkState() == Qt.Checked
+        new_prefs[KEY_USE_ASYNC_ENGINE] = self.use_async_engine_checkbox.checkState() == Qt.Checked
+        new_prefs[KEY_INCREMENTAL_REFRESH] = self.incremental_refresh_checkbox.checkState() == Qt.Checked
+
+        set_prefs(new_prefs)
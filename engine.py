@@ -0,0 +1,253 @@
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+__license__   = 'GPL v3'
+
+import ssl
+import zlib
+import gzip
+import socket
+import asyncio
+import concurrent.futures
+from email.parser import BytesParser
+from http.client import HTTPMessage
+from threading import Lock, Thread
+from urllib.error import URLError
+from urllib.parse import urljoin, urlsplit
+
+# Connections opened to any one host at the same time
+MAX_CONNECTIONS_PER_HOST = 6
+# Idle connections older than this are closed rather than reused
+IDLE_TIMEOUT = 30.0
+MAX_REDIRECTS = 5
+REDIRECT_CODES = frozenset((301, 302, 303, 307, 308))
+
+class Response(object):
+
+    '''
+    A fully read response, with the parts of the mechanize response interface
+    the plugin uses
+    '''
+
+    def __init__(self, url, code, headers, body):
+        self.url, self.code, self.headers, self.body = url, code, headers, body
+
+    def read(self):
+        return self.body
+
+    def getcode(self):
+        return self.code
+
+    def geturl(self):
+        return self.url
+
+    def info(self):
+        return self.headers
+
+class HTTPError(Exception):
+
+    '''
+    Raised for non 2xx responses, mirroring mechanize's HTTPError so that
+    callers can handle both the same way
+    '''
+
+    def __init__(self, url, code, headers, body):
+        Exception.__init__(self, 'HTTP Error %d: %s'%(code, url))
+        self.url, self.code, self.body = url, code, body
+        self.hdrs = self.headers = headers
+
+    def getcode(self):
+        return self.code
+
+    def info(self):
+        return self.hdrs
+
+class Connection(object):
+
+    def __init__(self, reader, writer, loop):
+        self.reader, self.writer = reader, writer
+        self.last_used = loop.time()
+
+    def close(self):
+        try:
+            self.writer.close()
+        except Exception:
+            pass
+
+class AsyncHTTPEngine(object):
+
+    '''
+    HTTP/1.1 client running on its own event loop thread. Connections are kept
+    alive and shared between requests, at most MAX_CONNECTIONS_PER_HOST per
+    host, and responses are requested gzip compressed. fetch is the blocking
+    entry point used from Worker threads.
+    '''
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.idle = {}
+        self.limits = {}
+        self.ssl_context = ssl.create_default_context()
+        self.thread = Thread(target=self.run_loop, name='WarGameVaultHTTP')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def fetch(self, url, timeout, headers=None, abort=None, poll_interval=0.2):
+        '''
+        Download url, blocking the calling thread. Raises HTTPError for error
+        responses and URLError for network failures and timeouts.
+        '''
+        future = asyncio.run_coroutine_threadsafe(
+                self.request(url, dict(headers or {}), timeout), self.loop)
+        while True:
+            try:
+                return future.result(poll_interval if abort is not None else None)
+            except concurrent.futures.TimeoutError:
+                if abort is not None and abort.is_set():
+                    future.cancel()
+                    raise URLError('Aborted: %s'%url)
+
+    async def request(self, url, headers, timeout):
+        try:
+            return await asyncio.wait_for(self.follow(url, headers), timeout)
+        except asyncio.TimeoutError:
+            raise URLError(socket.timeout('timed out'))
+        except (OSError, asyncio.IncompleteReadError, ValueError, zlib.error) as e:
+            raise URLError(e)
+
+    async def follow(self, url, headers):
+        for i in range(MAX_REDIRECTS + 1):
+            code, response_headers, body = await self.send(url, headers)
+            if code in REDIRECT_CODES and response_headers.get('Location'):
+                url = urljoin(url, response_headers['Location'])
+                continue
+            if 200 <= code < 300:
+                return Response(url, code, response_headers, body)
+            raise HTTPError(url, code, response_headers, body)
+        raise HTTPError(url, code, response_headers, body)
+
+    def limit(self, key):
+        sem = self.limits.get(key)
+        if sem is None:
+            sem = self.limits[key] = asyncio.Semaphore(MAX_CONNECTIONS_PER_HOST)
+        return sem
+
+    async def connect(self, key):
+        idle = self.idle.get(key, [])
+        now = self.loop.time()
+        while idle:
+            conn = idle.pop()
+            if now - conn.last_used < IDLE_TIMEOUT and not conn.reader.at_eof():
+                return conn, True
+            conn.close()
+        scheme, host, port = key
+        reader, writer = await asyncio.open_connection(host, port,
+                ssl=self.ssl_context if scheme == 'https' else None)
+        return Connection(reader, writer, self.loop), False
+
+    def release(self, key, conn):
+        conn.last_used = self.loop.time()
+        self.idle.setdefault(key, []).append(conn)
+
+    async def send(self, url, headers):
+        parts = urlsplit(url)
+        scheme = parts.scheme.lower()
+        port = parts.port or (443 if scheme == 'https' else 80)
+        key = (scheme, parts.hostname, port)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        host = parts.hostname if parts.port is None else '%s:%d'%(parts.hostname, parts.port)
+        lines = ['GET %s HTTP/1.1'%path, 'Host: %s'%host,
+                'Accept-Encoding: gzip, deflate', 'Connection: keep-alive']
+        lines += ['%s: %s'%(k, v) for k, v in headers.items()
+                if k.lower() not in ('host', 'accept-encoding', 'connection')]
+        raw_request = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+        async with self.limit(key):
+            conn, reused = await self.connect(key)
+            try:
+                try:
+                    result = await self.exchange(conn, raw_request)
+                except (OSError, asyncio.IncompleteReadError):
+                    if not reused:
+                        raise
+                    # The server closed the idle connection, try a fresh one
+                    conn.close()
+                    conn, reused = await self.connect_fresh(key)
+                    result = await self.exchange(conn, raw_request)
+            except BaseException:
+                conn.close()
+                raise
+            code, response_headers, body, keep_alive = result
+            if keep_alive:
+                self.release(key, conn)
+            else:
+                conn.close()
+        return code, response_headers, self.decode(response_headers, body)
+
+    async def connect_fresh(self, key):
+        # The other idle connections were opened as long ago as the stale one
+        for conn in self.idle.pop(key, []):
+            conn.close()
+        return await self.connect(key)
+
+    async def exchange(self, conn, raw_request):
+        conn.writer.write(raw_request)
+        await conn.writer.drain()
+        reader = conn.reader
+        head = await reader.readuntil(b'\r\n\r\n')
+        status_line, _, header_block = head.partition(b'\r\n')
+        version, code = status_line.split(None, 2)[:2]
+        code = int(code)
+        headers = BytesParser(_class=HTTPMessage).parsebytes(header_block)
+        keep_alive = version.upper() == b'HTTP/1.1' and \
+                (headers.get('Connection') or '').lower() != 'close'
+
+        if code in (204, 304) or 100 <= code < 200:
+            body = b''
+        elif (headers.get('Transfer-Encoding') or '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';')[0].strip(), 16)
+                if size == 0:
+                    # Skip any trailers
+                    while (await reader.readline()) not in (b'\r\n', b''):
+                        pass
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            body = b''.join(chunks)
+        elif headers.get('Content-Length') is not None:
+            body = await reader.readexactly(int(headers['Content-Length']))
+        else:
+            body = await reader.read()
+            keep_alive = False
+        return code, headers, body, keep_alive
+
+    def decode(self, headers, body):
+        encoding = (headers.get('Content-Encoding') or '').lower()
+        if encoding == 'gzip':
+            return gzip.decompress(body)
+        if encoding == 'deflate':
+            try:
+                return zlib.decompress(body)
+            except zlib.error:
+                return zlib.decompress(body, -zlib.MAX_WBITS)
+        return body
+
+_engine = None
+_engine_lock = Lock()
+
+def get_engine():
+    '''
+    Return the shared engine, starting its event loop thread on first use
+    '''
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = AsyncHTTPEngine()
+        return _engine
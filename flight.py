@@ -0,0 +1,84 @@
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+__license__   = 'GPL v3'
+
+from threading import Event, Lock
+
+from calibre_plugins.wargamevault.network import Aborted, is_timeout
+
+# Seconds between checks of the abort flag while waiting on other threads
+ABORT_CHECK_INTERVAL = 0.2
+
+def wait_for(event, abort):
+    '''
+    Wait for event, raising Aborted if abort is set first
+    '''
+    if abort is None:
+        event.wait()
+        return
+    while not event.wait(ABORT_CHECK_INTERVAL):
+        if abort.is_set():
+            raise Aborted('Aborted while waiting for another download')
+
+class Flight(object):
+
+    def __init__(self):
+        self.done = Event()
+        self.result = self.error = None
+        # Set when the call gave up because of its caller's abort or deadline,
+        # which says nothing about whether the waiters' own calls would work
+        self.abandoned = False
+
+class SingleFlight(object):
+
+    '''
+    Lets concurrent callers asking for the same key share one call: while a
+    call for a key is in flight, later callers wait for it and are handed its
+    result (or exception) rather than making the call again. If the call
+    is abandoned because its caller was aborted or ran out of time, a waiter
+    makes the call itself instead.
+    '''
+
+    def __init__(self):
+        self.flights = {}
+        self.lock = Lock()
+
+    def do(self, key, func, abort=None):
+        '''
+        Return (result, shared) where shared is True if the result came from
+        a call made by another thread. Waiting for another thread's call
+        raises Aborted once abort is set.
+        '''
+        while True:
+            with self.lock:
+                flight = self.flights.get(key)
+                leader = flight is None
+                if leader:
+                    flight = self.flights[key] = Flight()
+
+            if leader:
+                break
+            wait_for(flight.done, abort)
+            if flight.abandoned:
+                if abort is not None and abort.is_set():
+                    raise Aborted('Aborted while waiting for another download')
+                continue
+            if flight.error is not None:
+                raise flight.error
+            return flight.result, True
+
+        try:
+            flight.result = func()
+        except Exception as e:
+            if isinstance(e, Aborted) or is_timeout(e):
+                flight.abandoned = True
+            else:
+                flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.done.set()
+        return flight.result, False
+
+product_flights = SingleFlight()
@@ -0,0 +1,116 @@
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+__license__   = 'GPL v3'
+
+import os
+import json
+import time
+from contextlib import contextmanager
+from threading import Lock
+
+class Metrics(object):
+
+    '''
+    Thread safe phase timers and event counters, aggregated over a run until
+    reset() is called
+    '''
+
+    def __init__(self):
+        self.lock = Lock()
+        self.dump_lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            # name -> [count, total seconds, max seconds]
+            self.timers = {}
+            self.counters = {}
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            timer = self.timers.get(name)
+            if timer is None:
+                self.timers[name] = [1, seconds, seconds]
+            else:
+                timer[0] += 1
+                timer[1] += seconds
+                timer[2] = max(timer[2], seconds)
+
+    @contextmanager
+    def timer(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.monotonic() - start)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'started': self.started,
+                'elapsed': round(time.time() - self.started, 3),
+                'timers': {name: {'count': c, 'total': round(t, 4),
+                    'mean': round(t / c, 4), 'max': round(m, 4)}
+                    for name, (c, t, m) in self.timers.items()},
+                'counters': dict(self.counters),
+            }
+
+    def since(self, before):
+        '''
+        The timers and counters added since the snapshot before was taken.
+        Work done at the same time by other threads is included.
+        '''
+        after = self.snapshot()
+        timers = {}
+        for name, t in after['timers'].items():
+            b = before['timers'].get(name, {'count': 0, 'total': 0})
+            count = t['count'] - b['count']
+            if count > 0:
+                total = round(t['total'] - b['total'], 4)
+                timers[name] = {'count': count, 'total': total, 'mean': round(total / count, 4)}
+        counters = {}
+        for name, c in after['counters'].items():
+            c -= before['counters'].get(name, 0)
+            if c > 0:
+                counters[name] = c
+        return {
+            'started': round(before['started'] + before['elapsed'], 3),
+            'elapsed': round(after['elapsed'] - before['elapsed'], 3),
+            'timers': timers,
+            'counters': counters,
+        }
+
+    def to_json(self, snapshot=None):
+        return json.dumps(self.snapshot() if snapshot is None else snapshot,
+                indent=2, sort_keys=True)
+
+    def dump(self, path, snapshot=None):
+        '''
+        Write snapshot to path, replacing it in one step so that concurrent
+        identify calls, in this process or another, never leave it half written
+        '''
+        data = self.to_json(snapshot)
+        tmp = '%s.%d.tmp'%(path, os.getpid())
+        with self.dump_lock:
+            with open(tmp, 'w') as f:
+                f.write(data)
+            os.replace(tmp, path)
+
+    def summary(self, snapshot=None):
+        '''
+        A single line suitable for the calibre log
+        '''
+        if snapshot is None:
+            snapshot = self.snapshot()
+        timers = ' '.join('%s=%d/%.3fs'%(name, t['count'], t['total'])
+                for name, t in sorted(snapshot['timers'].items()))
+        counters = ' '.join('%s=%d'%(name, c)
+                for name, c in sorted(snapshot['counters'].items()))
+        return 'WarGameVault metrics: %s %s'%(timers, counters)
+
+metrics = Metrics()
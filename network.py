@@ -0,0 +1,269 @@
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+__license__   = 'GPL v3'
+
+import time
+import socket
+import logging
+from contextlib import contextmanager
+from email.utils import parsedate_tz, mktime_tz
+from threading import Lock, local
+
+import calibre_plugins.wargamevault.config as cfg
+from calibre_plugins.wargamevault.engine import get_engine
+from calibre_plugins.wargamevault.metrics import metrics
+
+class Aborted(Exception):
+    pass
+
+class Deadline(object):
+
+    '''
+    The time by which an identify or cover download must finish, combined
+    with calibre's abort flag. It can be passed anywhere an abort Event is
+    accepted, and reads as set once the call is aborted or out of time.
+    '''
+
+    def __init__(self, timeout, abort=None):
+        self.expires = time.monotonic() + timeout if timeout else None
+        self.abort = abort
+
+    def remaining(self):
+        if self.expires is None:
+            return None
+        return max(0.0, self.expires - time.monotonic())
+
+    def is_set(self):
+        if self.abort is not None and self.abort.is_set():
+            return True
+        return self.expires is not None and time.monotonic() >= self.expires
+
+    def aborted(self):
+        '''
+        True once calibre's abort flag is set, whether or not time is left
+        '''
+        return self.abort is not None and self.abort.is_set()
+
+    def wait(self, timeout=None):
+        remaining = self.remaining()
+        if remaining is not None:
+            timeout = remaining if timeout is None else min(timeout, remaining)
+        if self.abort is not None:
+            self.abort.wait(timeout)
+        elif timeout:
+            time.sleep(timeout)
+        return self.is_set()
+
+    def timeout(self, timeout):
+        '''
+        timeout cut down to the time left before the deadline
+        '''
+        remaining = self.remaining()
+        return timeout if remaining is None else min(timeout, remaining)
+
+class RateLimiter(object):
+
+    '''
+    Process wide token bucket shared by every request made to WarGameVault.
+
+    The refill rate grows additively while requests succeed and is halved when
+    they fail, and a 429 response pauses all requests for the Retry-After
+    period, so concurrent identify calls settle on the fastest rate the API
+    will sustain. max_rate, the ceiling, is set from the plugin preferences.
+    '''
+
+    def __init__(self, rate=5.0, min_rate=0.5, max_rate=100.0, burst=6,
+            increase=1.0, default_retry_after=5.0):
+        self.rate, self.min_rate, self.max_rate = rate, min_rate, max_rate
+        self.burst, self.increase = burst, increase
+        self.default_retry_after = default_retry_after
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, abort=None):
+        '''
+        Block until a request may be sent. Returns False if abort was set while
+        waiting.
+        '''
+        while True:
+            if abort is not None and abort.is_set():
+                return False
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now < self.paused_until:
+                    delay = self.paused_until - now
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                else:
+                    delay = (1 - self.tokens) / self.rate
+            if abort is not None:
+                abort.wait(delay)
+            else:
+                time.sleep(delay)
+
+    def set_max_rate(self, max_rate):
+        with self.lock:
+            self.max_rate = max(self.min_rate, float(max_rate))
+            self.rate = min(self.rate, self.max_rate)
+
+    def succeeded(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def failed(self):
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+
+    def throttled(self, retry_after=None):
+        if retry_after is None:
+            retry_after = self.default_retry_after
+        with self.lock:
+            now = time.monotonic()
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.paused_until = max(self.paused_until, now + retry_after)
+            self.tokens = 0.0
+
+rate_limiter = RateLimiter()
+
+class RedirectLogRouter(logging.Handler):
+
+    '''
+    The one handler on mechanize's redirect logger. Each record is passed on
+    to the log of the call running on the current thread, and dropped when
+    no call is routing to a log.
+    '''
+
+    def __init__(self):
+        logging.Handler.__init__(self, logging.INFO)
+        self.local = local()
+
+    def emit(self, record):
+        log = getattr(self.local, 'log', None)
+        if log is None:
+            return
+        try:
+            log.info(self.format(record))
+        except Exception:
+            self.handleError(record)
+
+    @contextmanager
+    def routing_to(self, log):
+        install_redirect_logging()
+        previous = getattr(self.local, 'log', None)
+        self.local.log = log
+        try:
+            yield
+        finally:
+            self.local.log = previous
+
+redirect_log = RedirectLogRouter()
+_redirect_log_installed = False
+_redirect_log_lock = Lock()
+
+def install_redirect_logging():
+    global _redirect_log_installed
+    if _redirect_log_installed:
+        return
+    with _redirect_log_lock:
+        if not _redirect_log_installed:
+            logger = logging.getLogger('mechanize.http_redirects')
+            logger.addHandler(redirect_log)
+            logger.setLevel(logging.INFO)
+            _redirect_log_installed = True
+
+# Number of times a request answered with 429 is retried before giving up
+MAX_THROTTLE_RETRIES = 3
+
+def error_code(e):
+    if callable(getattr(e, 'getcode', None)):
+        try:
+            return e.getcode()
+        except Exception:
+            pass
+    return None
+
+def retry_after(e):
+    headers = getattr(e, 'hdrs', None) or getattr(e, 'headers', None)
+    value = headers.get('Retry-After') if headers is not None else None
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    parsed = parsedate_tz(value)
+    if parsed is None:
+        return None
+    return max(0.0, mktime_tz(parsed) - time.time())
+
+def is_timeout(e):
+    if isinstance(e, socket.timeout):
+        return True
+    args = getattr(e, 'args', None) or [None]
+    return isinstance(args[0], socket.timeout) or \
+        isinstance(getattr(e, 'reason', None), socket.timeout)
+
+def send(br, url, timeout, abort, headers):
+    if cfg.get_options().get(cfg.KEY_USE_ASYNC_ENGINE):
+        # The engine does not go through br, but should still identify itself
+        # the same way
+        request_headers = dict(getattr(br, 'addheaders', None) or ())
+        request_headers.update(headers or {})
+        return get_engine().fetch(url, timeout, headers=request_headers, abort=abort)
+    if headers:
+        from mechanize import Request
+        return br.open_novisit(Request(url, headers=headers), timeout=timeout)
+    return br.open_novisit(url, timeout=timeout)
+
+def open_url(br, url, timeout, abort=None, log=None, headers=None):
+    '''
+    Open url with br, or the shared asyncio engine if it is enabled, once the
+    shared rate limiter allows it, retrying throttled requests after the delay
+    the server asked for. If abort is a Deadline no request is allowed to run
+    past it.
+    '''
+    attempt = 0
+    rate_limiter.set_max_rate(cfg.get_options().get(cfg.KEY_MAX_REQUEST_RATE))
+    while True:
+        with metrics.timer('http.rate_wait'):
+            allowed = rate_limiter.acquire(abort)
+        if not allowed:
+            metrics.count('http.aborted')
+            raise Aborted('Aborted while waiting to open: %s'%url)
+        metrics.count('http.requests')
+        request_timeout = abort.timeout(timeout) if isinstance(abort, Deadline) else timeout
+        try:
+            response = send(br, url, request_timeout, abort, headers)
+        except Exception as e:
+            if abort is not None and abort.is_set():
+                metrics.count('http.aborted')
+                raise Aborted('Aborted while opening: %s'%url)
+            code = error_code(e)
+            if code == 304:
+                rate_limiter.succeeded()
+            elif code == 429:
+                metrics.count('http.throttled')
+                delay = retry_after(e)
+                rate_limiter.throttled(delay)
+                if attempt < MAX_THROTTLE_RETRIES:
+                    metrics.count('http.retries')
+                    attempt += 1
+                    if log is not None:
+                        log.warn('WarGameVault throttled request, retrying in %s seconds: %s'%(
+                            rate_limiter.default_retry_after if delay is None else delay, url))
+                    continue
+            elif code is None or code >= 500:
+                # Only server side trouble and network failures say anything
+                # about how hard we are pushing the API
+                metrics.count('http.timeouts' if is_timeout(e) else 'http.errors')
+                rate_limiter.failed()
+            raise
+        rate_limiter.succeeded()
+        return response
@@ -0,0 +1,65 @@
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+__license__   = 'GPL v3'
+
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+import calibre_plugins.wargamevault.config as cfg
+
+class BrowserPool(object):
+
+    '''
+    Keeps a small set of cloned browsers that are handed out to Worker jobs in
+    turn, rather than cloning a fresh browser for every product
+    '''
+
+    def __init__(self, max_idle):
+        self.max_idle = max_idle
+        self.idle = []
+        self.lock = Lock()
+
+    @contextmanager
+    def browser(self, parent):
+        with self.lock:
+            br = self.idle.pop() if self.idle else None
+        if br is None:
+            br = parent.clone_browser()
+        try:
+            yield br
+        finally:
+            with self.lock:
+                if len(self.idle) < self.max_idle:
+                    self.idle.append(br)
+
+_lock = Lock()
+_executor = None
+_executor_size = None
+_browser_pool = None
+
+def get_executor():
+    '''
+    Return the process wide executor that Worker jobs are submitted to, sized
+    from the plugin preferences. Changing the preference replaces the executor,
+    letting jobs already queued on the old one finish.
+    '''
+    global _executor, _executor_size, _browser_pool
+    size = cfg.get_options().get(cfg.KEY_MAX_CONCURRENCY)
+    with _lock:
+        if _executor is None or _executor_size != size:
+            old = _executor
+            _executor = ThreadPoolExecutor(max_workers=size,
+                    thread_name_prefix='WarGameVaultWorker')
+            _executor_size = size
+            if _browser_pool is None:
+                _browser_pool = BrowserPool(size)
+            else:
+                _browser_pool.max_idle = size
+            if old is not None:
+                old.shutdown(wait=False)
+        return _executor
+
+def get_browser_pool():
+    get_executor()
+    return _browser_pool
@@ -0,0 +1,213 @@
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+__license__   = 'GPL v3'
+
+'''
+Fill the WarGameVault product and cover caches ahead of time, so that later
+metadata downloads in calibre are answered from disk. With the plugin
+installed, run either of:
+
+    calibre-debug -e prefetch.py -- --library "~/Calibre Library" --covers
+    calibre-debug -e prefetch.py -- 457226 457227 ...
+
+Ids can also be read from a file, one per line, with --ids-file. Products that
+were fetched successfully are recorded in a checkpoint file, so an interrupted
+or partly failed run picks up where it left off when started again; the
+checkpoint is deleted once a run finishes with no failures, and --restart
+ignores it. --help lists every option.
+'''
+
+import os
+import sys
+import time
+import argparse
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+CHECKPOINT_FILE_NAME = 'prefetch.checkpoint'
+
+def library_ids(path):
+    '''
+    The WarGameVault ids of every book in the calibre library at path
+    '''
+    from calibre.library import db
+    cache = db(os.path.expanduser(path)).new_api
+    identifiers = cache.all_field_for('identifiers', cache.all_book_ids())
+    return sorted({i['wargamevault'] for i in identifiers.values() if i.get('wargamevault')})
+
+def read_ids(opts):
+    ids = list(opts.ids)
+    if opts.ids_file:
+        with open(opts.ids_file) as f:
+            ids += [line.strip() for line in f]
+    if opts.library:
+        ids += library_ids(opts.library)
+    seen, unique = set(), []
+    for i in ids:
+        if i and i not in seen:
+            seen.add(i)
+            unique.append(i)
+    return unique
+
+class Checkpoint(object):
+
+    '''
+    Append-only file of the ids that have been prefetched
+    '''
+
+    def __init__(self, path, restart=False):
+        self.path = path
+        self.lock = threading.Lock()
+        self.done = set()
+        if restart and os.path.exists(path):
+            os.remove(path)
+        if os.path.exists(path):
+            with open(path) as f:
+                self.done = {line.strip() for line in f if line.strip()}
+        self.f = open(path, 'a')
+
+    def add(self, wargamevault_id):
+        with self.lock:
+            self.done.add(wargamevault_id)
+            self.f.write(wargamevault_id + '\n')
+            self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+    def remove(self):
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+class Progress(object):
+
+    def __init__(self, total, interval=2.0):
+        self.total, self.interval = total, interval
+        self.done = self.failed = 0
+        self.start = self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def update(self, ok):
+        with self.lock:
+            if ok:
+                self.done += 1
+            else:
+                self.failed += 1
+            now = time.monotonic()
+            if now - self.last >= self.interval or self.done + self.failed == self.total:
+                self.last = now
+                self.report(now)
+
+    def report(self, now=None):
+        elapsed = (now or time.monotonic()) - self.start
+        finished = self.done + self.failed
+        rate = finished / elapsed if elapsed else 0
+        eta = (self.total - finished) / rate if rate else 0
+        print('%d/%d products  %d failed  %.1f/s  about %ds left'%(
+            finished, self.total, self.failed, rate, eta))
+        sys.stdout.flush()
+
+def prefetch_one(plugin, log, abort, wargamevault_id, covers, timeout):
+    '''
+    Bring one product, and optionally its cover, into the caches. Returns
+    True if the product was found.
+    '''
+    identifiers = {'wargamevault': wargamevault_id}
+    rq = Queue()
+    plugin.identify(log, rq, abort, identifiers=identifiers, timeout=timeout)
+    if rq.empty():
+        return False
+    if covers:
+        plugin.download_cover(log, Queue(), abort, identifiers=identifiers, timeout=timeout)
+    return True
+
+def run(plugin, log, ids, checkpoint, parallel, covers, timeout):
+    todo = [i for i in ids if i not in checkpoint.done]
+    print('Prefetching %d products (%d already done)'%(len(todo), len(ids) - len(todo)))
+    progress = Progress(len(todo))
+    abort = threading.Event()
+
+    def one(wargamevault_id):
+        try:
+            ok = prefetch_one(plugin, log, abort, wargamevault_id, covers, timeout)
+        except Exception:
+            log.exception('Failed to prefetch WarGameVault product:', wargamevault_id)
+            ok = False
+        if ok:
+            checkpoint.add(wargamevault_id)
+        progress.update(ok)
+
+    # Only a few ids are in flight at a time, so huge libraries are streamed
+    # rather than queued up front, and an interrupt leaves little undone
+    pending = set()
+    with ThreadPoolExecutor(max_workers=parallel) as pool:
+        try:
+            for wargamevault_id in todo:
+                pending.add(pool.submit(one, wargamevault_id))
+                if len(pending) >= parallel * 2:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            wait(pending)
+        except KeyboardInterrupt:
+            print('Interrupted, finishing products in progress')
+            abort.set()
+            for f in pending:
+                f.cancel()
+            raise
+    return progress
+
+def option_parser():
+    parser = argparse.ArgumentParser(description='Fill the WarGameVault caches ahead of time')
+    parser.add_argument('ids', nargs='*', help='WarGameVault ids to prefetch')
+    parser.add_argument('--ids-file', help='File of WarGameVault ids, one per line')
+    parser.add_argument('--library', help='Prefetch every book with a WarGameVault id in this calibre library')
+    parser.add_argument('--covers', action='store_true', help='Also download and cache covers')
+    parser.add_argument('--parallel', type=int, default=4,
+            help='Products prefetched at the same time (default: %(default)s)')
+    parser.add_argument('--timeout', type=int, default=30,
+            help='Seconds allowed for each product (default: %(default)s)')
+    parser.add_argument('--checkpoint', help='Checkpoint file (default: in the plugin cache directory)')
+    parser.add_argument('--restart', action='store_true', help='Ignore the checkpoint and start again')
+    parser.add_argument('--verbose', action='store_true', help='Show the plugin log')
+    return parser
+
+def main(args=sys.argv[1:]):
+    opts = option_parser().parse_args(args)
+
+    from calibre.customize.ui import metadata_sources
+    from calibre.utils.logging import ThreadSafeLog
+    plugin = [p for p in metadata_sources() if p.name == 'WarGameVault'][0]
+    from calibre_plugins.wargamevault.cache import default_cache_dir, get_product_cache
+    from calibre_plugins.wargamevault.metrics import metrics
+
+    if get_product_cache() is None:
+        print('Caching is turned off in the WarGameVault plugin options, so nothing would be kept')
+        return 1
+    ids = read_ids(opts)
+    if not ids:
+        print('No WarGameVault ids to prefetch')
+        return 1
+    log = ThreadSafeLog(level=ThreadSafeLog.DEBUG if opts.verbose else ThreadSafeLog.ERROR)
+    checkpoint = Checkpoint(opts.checkpoint or
+            os.path.join(default_cache_dir(), CHECKPOINT_FILE_NAME), opts.restart)
+    try:
+        progress = run(plugin, log, ids, checkpoint, opts.parallel, opts.covers, opts.timeout)
+    except KeyboardInterrupt:
+        return 1
+    finally:
+        checkpoint.close()
+    if not progress.failed:
+        # Everything asked for is cached, so the next run should check all
+        # of it again rather than skip it
+        checkpoint.remove()
+    print('Prefetched %d products, %d failed'%(progress.done, progress.failed))
+    if opts.verbose:
+        print(metrics.summary())
+    return 0 if not progress.failed else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,86 @@
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+__license__   = 'GPL v3'
+
+import re
+import json
+from collections import namedtuple
+
+# The WarGameVault id in a product URL
+PRODUCT_URL_PATTERN = re.compile(r'/products/(\d*)')
+
+# Marks cached JSON as a compact ProductRecord rather than a full API response
+RECORD_FORMAT = 1
+
+# A product found by a search, before its details have been fetched
+Candidate = namedtuple('Candidate', 'url name authors')
+
+class ProductRecord(object):
+
+    '''
+    The parts of a WarGameVault product document that the plugin uses,
+    extracted in a single pass over the API response
+    '''
+
+    __slots__ = ('name', 'description', 'authors', 'artists', 'editors',
+            'contributors', 'isbn', 'image', 'date_created', 'publisher',
+            'categories', 'filters')
+
+    def __init__(self, name, description=None, authors=(), artists=(),
+            editors=(), contributors=(), isbn=None, image=None,
+            date_created=None, publisher=None, categories=(), filters=()):
+        self.name, self.description = name, description
+        self.authors, self.artists = list(authors), list(artists)
+        self.editors, self.contributors = list(editors), list(contributors)
+        self.isbn, self.image, self.date_created = isbn, image, date_created
+        self.publisher = publisher
+        self.categories, self.filters = list(categories), list(filters)
+
+    @classmethod
+    def from_json(cls, raw):
+        '''
+        Build a record from either a raw API response or a record previously
+        serialized with to_json. Raises KeyError if there is no product name.
+        '''
+        if isinstance(raw, bytes):
+            raw = raw.decode('utf-8', errors='replace')
+        data = json.loads(raw)
+        if data.get('format') == RECORD_FORMAT:
+            return cls(**data['record'])
+        return cls.from_data(data)
+
+    @classmethod
+    def from_data(cls, data):
+        attributes = data['data']['attributes']
+        description = attributes.get('description') or {}
+        publisher = None
+        categories, filters = [], []
+        for include in data.get('included') or ():
+            kind = include.get('type')
+            try:
+                if kind == 'Publisher':
+                    if publisher is None:
+                        publisher = include['attributes']['name']
+                elif kind == 'Category' or kind == 'Filter':
+                    name = include['attributes']['descriptions'][0]['name'].replace("&#039;","'")
+                    (categories if kind == 'Category' else filters).append(name)
+            except (KeyError, IndexError, TypeError, AttributeError):
+                # A malformed include only costs us that one publisher or tag
+                continue
+        return cls(description['name'],
+                description=description.get('description'),
+                authors=attributes.get('authors') or (),
+                artists=attributes.get('artists') or (),
+                editors=attributes.get('editors') or (),
+                contributors=attributes.get('contributors') or (),
+                isbn=attributes.get('isbn'),
+                image=attributes.get('image'),
+                date_created=attributes.get('dateCreated'),
+                publisher=publisher,
+                categories=categories,
+                filters=filters)
+
+    def to_json(self):
+        return json.dumps({'format': RECORD_FORMAT,
+            'record': {k: getattr(self, k) for k in self.__slots__}},
+            separators=(',', ':'))
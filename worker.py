@@ -3,57 +3,103 @@ from __future__ import unicode_literals, division, absolute_import, print_functi
 __license__   = 'GPL v3'
 
 import socket
-import re
-import datetime
 import json
-from threading import Thread
+import time
+import hashlib
+import datetime
 
 from calibre.ebooks.metadata.book.base import Metadata
 
 import calibre_plugins.wargamevault.config as cfg
-
-class Worker(Thread): # Get details
+from calibre_plugins.wargamevault.cache import (get_isbn_index, get_negative_cache,
+        get_product_cache)
+from calibre_plugins.wargamevault.catalog import get_catalog_index
+from calibre_plugins.wargamevault.flight import product_flights
+from calibre_plugins.wargamevault.metrics import metrics
+from calibre_plugins.wargamevault.network import Aborted, error_code, open_url, redirect_log
+from calibre_plugins.wargamevault.product import PRODUCT_URL_PATTERN, ProductRecord
+from calibre_plugins.wargamevault.pool import get_browser_pool
+
+# Preferences that change the metadata parse_details produces from a product,
+# and so are part of its fingerprint
+FINGERPRINT_OPTIONS = (cfg.KEY_GET_CATEGORY_AS_TAGS, cfg.KEY_GET_FILTER_AS_TAGS,
+        cfg.KEY_GET_ARTISTS_AS_AUTHORS, cfg.KEY_GET_EDITORS_AS_AUTHORS,
+        cfg.KEY_GET_CONTRIBUTORS_AS_AUTHORS)
+
+class Worker(object): # Get details
 
     '''
-    Get book details from WarGameVault book page in a separate thread
+    Get book details from WarGameVault book page as a job on the shared
+    worker pool
     '''
 
-    def __init__(self, url, result_queue, browser, log, relevance, plugin, timeout=20):
-        Thread.__init__(self)
-        self.daemon = True
+    def __init__(self, url, result_queue, browser, log, relevance, plugin, timeout=20,
+            options=None, abort=None):
         self.url, self.result_queue = url, result_queue
         self.log, self.timeout = log, timeout
+        # Usually the Deadline of the identify call the job belongs to
+        self.abort = abort
         self.relevance, self.plugin = relevance, plugin
-        self.browser = browser.clone_browser()
+        self.options = cfg.get_options() if options is None else options
+        # A browser is only borrowed from the pool once a download is actually
+        # needed, so workers that are fed cached product details never use one
+        self.parent_browser, self.browser = browser, None
         self.cover_url = self.wargamevault_id = self.isbn = None
+        self.refresh = self.options.get(cfg.KEY_INCREMENTAL_REFRESH)
+        self.created = time.monotonic()
 
     def run(self):
+        metrics.add_time('worker.queued', time.monotonic() - self.created)
+        if self.abort is not None and self.abort.is_set():
+            # Queued jobs are never started once their identify call has been
+            # aborted or run out of time
+            metrics.count('worker.cancelled')
+            return
         try:
-            self.get_details()
+            with get_browser_pool().browser(self.parent_browser) as br:
+                self.browser = br
+                try:
+                    self.get_details()
+                finally:
+                    self.browser = None
         except:
             self.log.exception('get_details failed for url: %r'%self.url)
 
     def get_details(self):
         self.log.info('Starting the get_details method')
+        if self.known_missing():
+            self.log.error('URL malformed, not found recently: %r'%self.url)
+            metrics.count('worker.known_miss')
+            return
         try:
             self.log.info('WarGameVault product url: %r'%self.url)
+            if self.browser is None:
+                self.browser = self.parent_browser.clone_browser()
             self.browser.set_handle_redirect(True)
             self.browser.set_debug_redirects(True)
-            import logging
-            logger = logging.getLogger("mechanize.http_redirects")
-            logger.addHandler(self.log)
-            logger.setLevel(logging.INFO)
-            raw = self.browser.open_novisit(self.url, timeout=self.timeout).read().strip()
+            with redirect_log.routing_to(self.log):
+                if self.refresh and self.revalidate():
+                    return
+                # Workers for a product that is already being downloaded wait
+                # for that download and share its record
+                record, shared = product_flights.do(self.url, self.download, abort=self.abort)
+        except Aborted:
+            self.log.info('Abandoned fetching product details for url: %r'%self.url)
+            metrics.count('worker.cancelled')
+            return
         except Exception as e:
             if callable(getattr(e, 'getcode', None)) and \
                     e.getcode() == 404:
                 self.log.error('URL malformed: %r'%self.url)
+                metrics.count('worker.not_found')
+                self.remember_missing()
                 return
             attr = getattr(e, 'args', [None])
             attr = attr if attr else [None]
             if isinstance(attr[0], socket.timeout):
                 msg = 'WarGameVault timed out. Try again later.'
                 self.log.error(msg)
+                metrics.count('worker.timeout')
             else:
                 msg = 'Failed to make details query: %r'%self.url
                 self.log.exception(msg)
@@ -66,26 +112,252 @@ class Worker(Thread): # Get details
             return
         '''
 
+        if shared:
+            self.log.info('Shared product details downloaded for another search: %r'%self.url)
+            metrics.count('worker.shared')
+        if record is not None:
+            with metrics.timer('worker.parse_details'):
+                self.parse_details(record)
+
+    def known_missing(self):
         try:
-            data = json.loads(raw)
-            #self.log.info(data)
+            cache = get_negative_cache()
+            return cache is not None and \
+                cache.get(cache.product_key(self.parse_wargamevault_id(self.url)))
         except:
-            msg = 'Failed to parse WarGameVault product page: %r'%self.url
-            self.log.exception(msg)
-            return
+            self.log.exception('Failed to read the negative cache for url: %r'%self.url)
+            return False
+
+    def remember_missing(self):
+        try:
+            cache = get_negative_cache()
+            if cache is not None:
+                cache.put(cache.product_key(self.parse_wargamevault_id(self.url)))
+        except:
+            self.log.exception('Failed to remember missing product for url: %r'%self.url)
+
+    def download(self):
+        '''
+        Download and decode the product, caching it if it held a usable
+        product. Returns the ProductRecord or None.
+        '''
+        with metrics.timer('worker.fetch'):
+            response = open_url(self.browser, self.url, self.timeout, abort=self.abort,
+                    log=self.log)
+            raw = response.read().strip()
+        record = self.decode(raw)
+        if record is not None:
+            self.store(record)
+            self.store_validators(response)
+        return record
+
+    def revalidate(self):
+        '''
+        Check a product seen before for changes with a conditional request,
+        replaying the metadata kept for it if it is unchanged. Returns False if
+        nothing is kept for the product, or its cached copy is gone, so it has
+        to be downloaded as usual.
+        '''
+        cache = get_product_cache()
+        if cache is None:
+            return False
+        wargamevault_id = self.parse_wargamevault_id(self.url)
+        state = cache.get_state(wargamevault_id)
+        if state is None or not state[3]:
+            return False
+        etag, last_modified, fingerprint, metadata = state
+
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        try:
+            with metrics.timer('worker.fetch'):
+                response = open_url(self.browser, self.url, self.timeout, abort=self.abort,
+                        log=self.log, headers=headers)
+                raw = response.read().strip()
+        except Exception as e:
+            if error_code(e) != 304:
+                raise
+            # The kept metadata may have been made with other preferences, so
+            # it is only replayed if the cached product still fingerprints the
+            # same, and otherwise the cached product is parsed again
+            cached = cache.get(wargamevault_id, allow_stale=True)
+            if not cached:
+                return False
+            self.log.info('Product is unchanged: %r'%self.url)
+            metrics.count('refresh.not_modified')
+            cache.touch(wargamevault_id)
+            if self.fingerprint(cached) == fingerprint:
+                self.replay(wargamevault_id, metadata)
+            else:
+                self.parse_raw(cached)
+            return True
+
+        record = self.decode(raw)
+        if record is None:
+            return True
+        self.store(record)
+        self.store_validators(response)
+        if self.fingerprint(record.to_json()) == fingerprint:
+            self.log.info('Product details are unchanged: %r'%self.url)
+            metrics.count('refresh.unchanged')
+            self.replay(wargamevault_id, metadata)
+        else:
+            metrics.count('refresh.changed')
+            with metrics.timer('worker.parse_details'):
+                self.parse_details(record)
+        return True
+
+    def store_validators(self, response):
+        '''
+        Keep the ETag and Last-Modified of a downloaded product for the
+        conditional request of the next refresh
+        '''
+        try:
+            cache = get_product_cache()
+            if cache is not None:
+                info = response.info()
+                cache.put_validators(self.parse_wargamevault_id(self.url),
+                        info.get('ETag'), info.get('Last-Modified'))
+        except:
+            self.log.exception('Failed to store validators for url: %r'%self.url)
+
+    def fingerprint(self, record_json):
+        '''
+        Hash of everything parse_details bases the metadata on
+        '''
+        prefs = [self.options.get(key) for key in FINGERPRINT_OPTIONS]
+        return hashlib.sha1(json.dumps([record_json, prefs, self.plugin.COVER_BASE_URL],
+            separators=(',', ':')).encode('utf-8')).hexdigest()
+
+    def remember(self, record, mi):
+        '''
+        Keep the cleaned metadata for a product, so the next refresh can
+        replay it if the product has not changed
+        '''
+        try:
+            cache = get_product_cache()
+            if cache is None:
+                return
+            metadata = json.dumps({
+                'title': mi.title, 'authors': mi.authors, 'isbn': mi.isbn,
+                'comments': mi.comments, 'tags': mi.tags, 'publisher': mi.publisher,
+                'pubdate': mi.pubdate.isoformat() if mi.pubdate else None,
+                'cover_url': self.cover_url})
+            cache.put_metadata(self.wargamevault_id, self.fingerprint(record.to_json()), metadata)
+        except:
+            self.log.exception('Failed to keep metadata for url: %r'%self.url)
+
+    def replay(self, wargamevault_id, metadata):
+        '''
+        Queue the metadata kept by remember, without parsing or cleaning it
+        again
+        '''
+        data = json.loads(metadata)
+        mi = Metadata(data['title'], data['authors'])
+        mi.set_identifier('wargamevault', wargamevault_id)
+        self.wargamevault_id = wargamevault_id
+        if data.get('isbn'):
+            self.isbn = mi.isbn = data['isbn']
+        for field in ('comments', 'tags', 'publisher'):
+            if data.get(field):
+                setattr(mi, field, data[field])
+        if data.get('pubdate'):
+            mi.pubdate = datetime.datetime.fromisoformat(data['pubdate'])
+        self.cover_url = data.get('cover_url')
+        mi.has_cover = bool(self.cover_url)
+        mi.source_relevance = self.relevance
+        self.cache_identifiers()
+        metrics.count('refresh.replayed')
+        self.log.info('Adding kept Metadata item to result_queue')
+        self.result_queue.put(mi)
+
+    def store(self, record):
+        '''
+        Keep a freshly downloaded product in the on-disk cache and the local
+        catalog index
+        '''
+        try:
+            wargamevault_id = self.parse_wargamevault_id(self.url)
+            cache = get_product_cache()
+            if cache is not None:
+                # Only the compact record is kept, which is also much
+                # quicker to decode on the next run
+                cache.put(wargamevault_id, record.to_json())
+            index = get_catalog_index()
+            if index is not None:
+                index.add(wargamevault_id, record)
+        except:
+            self.log.exception('Failed to cache product details for url: %r'%self.url)
 
+    def parse_cached(self):
+        '''
+        Parse the product from the on-disk cache, returning True if a fresh
+        cached copy was found and parsed
+        '''
         try:
-            # Look at the Name attribute to make sure we were actually returned
-            # the JSON for a book
-            name = data['data']['attributes']['description']['name']
+            cache = get_product_cache()
+            raw = cache.get(self.parse_wargamevault_id(self.url)) if cache is not None else None
         except:
+            self.log.exception('Failed to read cached product for url: %r'%self.url)
+            return False
+        if raw and self.refresh and self.replay_cached(cache, raw):
+            self.log.info('Used kept metadata for url: %r'%self.url)
+            metrics.count('cache.product.hit')
+            return True
+        if raw and self.parse_raw(raw) is not None:
+            self.log.info('Used cached product details for url: %r'%self.url)
+            metrics.count('cache.product.hit')
+            return True
+        metrics.count('cache.product.miss')
+        return False
+
+    def replay_cached(self, cache, raw):
+        '''
+        Replay the kept metadata if it was made from this cached product with
+        the current preferences
+        '''
+        try:
+            wargamevault_id = self.parse_wargamevault_id(self.url)
+            state = cache.get_state(wargamevault_id)
+            if state is None or not state[3] or state[2] != self.fingerprint(raw):
+                return False
+            self.replay(wargamevault_id, state[3])
+            return True
+        except:
+            self.log.exception('Failed to replay kept metadata for url: %r'%self.url)
+            return False
+
+    def parse_raw(self, raw):
+        '''
+        Decode the raw product JSON and parse it, returning the ProductRecord
+        if it held a usable product, otherwise None
+        '''
+        record = self.decode(raw)
+        if record is not None:
+            with metrics.timer('worker.parse_details'):
+                self.parse_details(record)
+        return record
+
+    def decode(self, raw):
+        try:
+            with metrics.timer('worker.decode'):
+                record = ProductRecord.from_json(raw)
+        except KeyError:
+            # The record is built around the Name attribute, so its absence
+            # means we were not actually returned the JSON for a book
             msg = 'Failed to find WarGameVault product name in JSON data: %r'%self.url
             self.log.exception(msg)
-            return
-
-        self.parse_details(data)
+            return None
+        except:
+            msg = 'Failed to parse WarGameVault product page: %r'%self.url
+            self.log.exception(msg)
+            return None
+        return record
 
-    def parse_details(self, data):
+    def parse_details(self, record):
         self.log.info('Started the parse_details process')
 
         try:
@@ -96,13 +368,13 @@ class Worker(Thread): # Get details
             wargamevault_id = None
 
         try:
-            title = self.parse_title(data)
+            title = self.parse_title(record)
         except:
             self.log.exception('Error parsing title for url: %r'%self.url)
             title = None
 
         try:
-            authors = self.parse_authors(data)
+            authors = self.parse_authors(record)
         except:
             self.log.exception('Error parsing authors for url: %r'%self.url)
             authors = []
@@ -118,77 +390,94 @@ class Worker(Thread): # Get details
         self.wargamevault_id = wargamevault_id
 
         try:
-            isbn = self.parse_isbn(data)
+            isbn = self.parse_isbn(record)
             if isbn:
                 self.isbn = mi.isbn = isbn
         except:
             self.log.exception('Error parsing ISBN for url: %r'%self.url)
 
         try:
-            mi.comments = self.parse_comments(data)
+            mi.comments = self.parse_comments(record)
         except:
             self.log.exception('Error parsing comments for url: %r'%self.url)
 
         try:
-            self.cover_url = self.parse_cover(data)
+            self.cover_url = self.parse_cover(record)
         except:
             self.log.exception('Error parsing cover for url: %r'%self.url)
         mi.has_cover = bool(self.cover_url)
 
         try:
-            tags = self.parse_tags(data)
+            tags = self.parse_tags(record)
             if tags:
                 mi.tags = tags
         except:
             self.log.exception('Error parsing tags for url: %r'%self.url)
 
         try:
-            mi.pubdate = self.parse_publish_date(data)
+            mi.pubdate = self.parse_publish_date(record)
         except:
             self.log.exception('Error parsing publish date for url: %r'%self.url)
 
         try:
-            mi.publisher = self.parse_publisher(data)
+            mi.publisher = self.parse_publisher(record)
         except:
             self.log.exception('Error parsing publisher for url: %r'%self.url)
 
         mi.source_relevance = self.relevance
 
-        if self.wargamevault_id:
-            if self.isbn:
-                self.plugin.cache_isbn_to_identifier(self.isbn, self.wargamevault_id)
-            if self.cover_url:
-                self.plugin.cache_identifier_to_cover_url(self.wargamevault_id, self.cover_url)
+        self.cache_identifiers()
+
+        with metrics.timer('worker.clean'):
+            self.plugin.clean_downloaded_metadata(mi)
 
-        self.plugin.clean_downloaded_metadata(mi)
+        if self.refresh:
+            self.remember(record, mi)
 
         self.log.info('Adding Metadata item to result_queue')
         self.result_queue.put(mi)
 
+    def cache_identifiers(self):
+        if not self.wargamevault_id:
+            return
+        if self.isbn:
+            if self.plugin.cached_isbn_to_identifier(self.isbn) != self.wargamevault_id:
+                # First time this process has seen the pairing, so make
+                # sure it is persisted for ISBN lookups in later runs
+                try:
+                    isbn_index = get_isbn_index()
+                    if isbn_index is not None:
+                        isbn_index.put(self.isbn, self.wargamevault_id)
+                except:
+                    self.log.exception('Failed to store ISBN for url: %r'%self.url)
+            self.plugin.cache_isbn_to_identifier(self.isbn, self.wargamevault_id)
+        if self.cover_url:
+            self.plugin.cache_identifier_to_cover_url(self.wargamevault_id, self.cover_url)
+
     def parse_wargamevault_id(self, url):
-        return re.search(r'/products/(\d*)', url).groups(0)[0]
+        return PRODUCT_URL_PATTERN.search(url).groups(0)[0]
 
-    def parse_title(self, data):
-        title = data['data']['attributes']['description']['name']
+    def parse_title(self, record):
+        title = record.name
         if not title:
             self.log("parse_title: no title found")
             return None
         self.log("parse_title: title=", title)
         return title.replace('>','').strip()
 
-    def parse_authors(self, data):
+    def parse_authors(self, record):
         # WarGameVault has multiple contributor categories
         # which can be included as Authors depending on the user's preference.
-        get_artists = cfg.plugin_prefs[cfg.STORE_NAME].get(cfg.KEY_GET_ARTISTS_AS_AUTHORS)
-        get_editors = cfg.plugin_prefs[cfg.STORE_NAME].get(cfg.KEY_GET_EDITORS_AS_AUTHORS)
-        get_contributors = cfg.plugin_prefs[cfg.STORE_NAME].get(cfg.KEY_GET_CONTRIBUTORS_AS_AUTHORS)
-        authors = data['data']['attributes']['authors']
+        get_artists = self.options.get(cfg.KEY_GET_ARTISTS_AS_AUTHORS)
+        get_editors = self.options.get(cfg.KEY_GET_EDITORS_AS_AUTHORS)
+        get_contributors = self.options.get(cfg.KEY_GET_CONTRIBUTORS_AS_AUTHORS)
+        authors = list(record.authors)
         if get_artists:
-            authors += data['data']['attributes']['artists']
+            authors += record.artists
         if get_editors:
-            authors += data['data']['attributes']['editors']
+            authors += record.editors
         if get_contributors:
-            authors += data['data']['attributes']['contributors']
+            authors += record.contributors
 
         if len(authors) == 0:
             authors = ['Unknown']
@@ -196,46 +485,45 @@ class Worker(Thread): # Get details
         self.log("parse_authors: authors=", authors)
         return authors
 
-    def parse_comments(self, data):
-        comments = data['data']['attributes']['description']['description']
+    def parse_comments(self, record):
+        comments = record.description
         #self.log('parse_comments: comments=', comments)
         if comments:
             return comments
 
-    def parse_cover(self, data):
-        img_url = ('https://d1vzi28wh99zvq.cloudfront.net/images/' +
-            data['data']['attributes']['image'])
+    def parse_cover(self, record):
+        img_url = self.plugin.COVER_BASE_URL + record.image
         self.log('parse_cover: img_url=', img_url)
         if img_url:
             return img_url
 
-    def parse_isbn(self, data):
-        isbn = data['data']['attributes']['isbn']
+    def parse_isbn(self, record):
+        isbn = record.isbn
         self.log('parse_isbn: isbn=', isbn)
         if isbn:
             return isbn
 
-    def parse_publish_date(self, data):
-        pub_date = data['data']['attributes']['dateCreated']
+    def parse_publish_date(self, record):
+        pub_date = record.date_created
         self.log('parse_publish_date: pub_date=', pub_date)
         if pub_date:
             return datetime.datetime.fromisoformat(pub_date)
 
-    def parse_publisher(self, data):
-        for include in data['included']:
-            if include['type'] == 'Publisher':
-                publisher = include['attributes']['name']
-                self.log('parse_publisher: publisher=', publisher)
-                return publisher
+    def parse_publisher(self, record):
+        publisher = record.publisher
+        self.log('parse_publisher: publisher=', publisher)
+        if publisher:
+            return publisher
 
-    def parse_tags(self, data):
+    def parse_tags(self, record):
         # WarGameVault has multiple optional sections which can be used as tags depending on the user's preference.
         calibre_tags = []
-        get_category = cfg.plugin_prefs[cfg.STORE_NAME].get(cfg.KEY_GET_CATEGORY_AS_TAGS)
-        get_filter = cfg.plugin_prefs[cfg.STORE_NAME].get(cfg.KEY_GET_FILTER_AS_TAGS)
-        for include in data['included']:
-            if (get_category and include['type'] == 'Category') or (get_filter and include['type'] == 'Filter'):
-                calibre_tags.append((include['attributes']['descriptions'][0]['name']).replace("&#039;","'"))
+        get_category = self.options.get(cfg.KEY_GET_CATEGORY_AS_TAGS)
+        get_filter = self.options.get(cfg.KEY_GET_FILTER_AS_TAGS)
+        if get_category:
+            calibre_tags += record.categories
+        if get_filter:
+            calibre_tags += record.filters
 
         self.log('parse_tags: calibre_tags=', calibre_tags)
         if len(calibre_tags) > 0: